@@ -13,29 +13,45 @@ __author__ = ["Luke Chang"]
 __license__ = "MIT"
 
 import os
+import tempfile
+import atexit
+import weakref
 import cPickle 
 import nibabel as nib
-from nltools.utils import get_resource_path, set_algorithm, get_anatomical
+from nltools.utils import set_algorithm, get_anatomical
 from nltools.cross_validation import set_cv
 from nltools.plotting import dist_from_hyperplane_plot, scatterplot, probability_plot, roc_plot
-from nltools.stats import pearson
-from nltools.mask import expand_mask
+from nltools.stats import (ols_factor, ols_fit, ols_contrast, permutation_max_t, fwe_p,
+                            permutation_cluster, cluster_labels, cluster_extent, tfce,
+                            RunningStats)
+from nltools.mask import (load_mask, get_masker, get_mask_hash, get_adjacency,
+                          get_mask_alignment, get_roi_matrix, get_resampling_operator,
+                          get_mask_indices)
 from nltools.analysis import Roc
-from nilearn.input_data import NiftiMasker
-from nilearn.image import resample_img
 from nilearn.masking import intersect_masks
+from nilearn.image import index_img
 from nilearn.plotting.img_plotting import plot_epi, plot_roi, plot_stat_map
-from copy import deepcopy
+from copy import deepcopy, copy
 import pandas as pd
 import numpy as np
-from scipy.stats import ttest_1samp, t, norm
+from scipy.stats import ttest_1samp, norm, rankdata
+from scipy import sparse
 import six
 import sklearn
 from sklearn.pipeline import Pipeline
 from sklearn.metrics.pairwise import pairwise_distances
+from sklearn.externals.joblib import Parallel, delayed, cpu_count
+from sklearn.utils import check_random_state
 
 from nltools.pbs_job import PBS_Job
 
+# (pid, file name) of shared memory files created by Brain_Data.to_shared_memory
+_shared_files = set()
+# Weak references to the instances owning _shared_files, keyed by file
+_shared_owners = {}
+# Free space to leave in /dev/shm beyond the data (cf. joblib's SYSTEM_SHARED_MEM_FS_MIN_SIZE)
+_SHARED_MEMORY_MARGIN = 2**27
+
 class Brain_Data(object):
 
     """
@@ -48,42 +64,46 @@ class Brain_Data(object):
         X: Pandas DataFrame Design Matrix for running univariate models 
         mask: binary nifiti file to mask brain data
         output_file: Name to write out to nifti file
+        memmap: .npy file name (or True for a temporary file) to store data in
+                an on-disk memory map instead of memory
+        n_jobs: number of threads used to load and mask a list of files
+        dtype: data type of data and derived images (e.g., 'float32'; default: Brain_Data.dtype)
+        verbose: report progress while loading a list of files
         **kwargs: Additional keyword arguments to pass to the prediction algorithm
 
     """
 
-    def __init__(self, data=None, Y=None, X=None, mask=None, output_file=None, **kwargs):
-        if mask is not None:
-            if not isinstance(mask, nib.Nifti1Image):
-                if type(mask) is str:
-                    if os.path.isfile(mask):
-                        mask = nib.load(mask)
-            else:
-                raise ValueError("mask is not a nibabel instance")
-            self.mask = mask
-        else:
-            self.mask = nib.load(os.path.join(get_resource_path(),'MNI152_T1_2mm_brain_mask.nii.gz'))
-        self.nifti_masker = NiftiMasker(mask_img=self.mask)
+    # Default data type of data and derived images.  Set Brain_Data.dtype to
+    # change it globally or pass dtype to change it for a single instance.
+    dtype = np.float64
+
+    # Number of values processed at a time when data is memory-mapped
+    chunk_size = 2**24
+
+    def __init__(self, data=None, Y=None, X=None, mask=None, output_file=None, memmap=None, n_jobs=1, verbose=False, dtype=None, **kwargs):
+        if dtype is not None:
+            self.dtype = np.dtype(dtype).type
+        # Masks and maskers are shared by all instances through the mask cache
+        self.mask = load_mask(mask)
+        self.nifti_masker = get_masker(self.mask)
 
         if data is not None:
             if type(data) is str:
                 data=nib.load(data)
-                self.data = self.nifti_masker.fit_transform(data)
+                self.data = self._cast(self.nifti_masker.transform(data))
             elif type(data) is list:
                 # Load and transform each image in list separately (nib.concat_images(data) can't handle images of different sizes)
-                self.data = []
-                for i in data:
-                    if isinstance(i,six.string_types):
-                        self.data.append(self.nifti_masker.fit_transform(nib.load(i)))
-                    elif isinstance(i,nib.Nifti1Image):
-                        self.data.append(self.nifti_masker.fit_transform(i))
-                self.data = np.array(self.data)
-            elif not isinstance(data, nib.Nifti1Image):
+                self.data = _load_images(data, self.nifti_masker, dtype=self.dtype, memmap=memmap, n_jobs=n_jobs, verbose=verbose)
+            elif isinstance(data, nib.Nifti1Image):
+                self.data = self._cast(self.nifti_masker.transform(data))
+            else:
                 raise ValueError("data is not a nibabel instance")
 
             # Collapse any extra dimension
             if any([x==1 for x in self.data.shape]):
                 self.data=self.data.squeeze()
+            if memmap is not None and not isinstance(self.data, np.memmap):
+                self.data = self.to_memmap(memmap).data
         else:
             self.data = np.array([])
 
@@ -119,18 +139,73 @@ class Brain_Data(object):
             self.shape(),
             len(self.Y),
             self.X.shape,
-            os.path.basename(self.mask.get_filename()),
+            os.path.basename(self.mask.get_filename() or ''),
             self.file_name
             )
 
+    def __copy__(self):
+        # Shallow copies share all attributes and skip __getstate__
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        return new
+
+    def __getstate__(self):
+        """ Pickle the mask and masker by reference (file name and hash, or
+            packed voxel bits) and memory-mapped data by file name, so worker
+            processes rebuild them from their caches instead of receiving
+            copies.  Append buffers are dropped.
+
+        """
+
+        state = self.__dict__.copy()
+        state.pop('_append_buffers', None)
+        state.pop('_shared_memory', None)
+        state.pop('_views', None)
+        state['mask'] = _mask_reference(self.mask)
+        state['nifti_masker'] = _mask_reference(self.nifti_masker.mask_img)
+        state['data'] = _data_reference(self.data)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Instances pickled before masks were stored by reference hold the
+        # mask image and masker themselves
+        if isinstance(state['mask'], dict):
+            self.mask = _load_mask_reference(state['mask'])
+        if isinstance(state['nifti_masker'], dict):
+            self.nifti_masker = get_masker(_load_mask_reference(state['nifti_masker']))
+        self.data = _load_data_reference(state['data'])
+
+    def __deepcopy__(self, memo):
+        # Share cached mask and nifti_masker instead of copying them
+        memo[id(self.mask)] = self.mask
+        memo[id(self.nifti_masker)] = self.nifti_masker
+        new = copy(self)
+        memo[id(self)] = new
+        for key, value in six.iteritems(self.__dict__):
+            if key not in ['_append_buffers', '_shared_memory', '_views']:
+                setattr(new, key, deepcopy(value, memo))
+        new.__dict__.pop('_append_buffers', None)
+        new.__dict__.pop('_shared_memory', None)
+        new.__dict__.pop('_views', None)
+        return new
+
     def __getitem__(self, index):
-        new = deepcopy(self)
-        if isinstance(index, int):
-            new.data = np.array(self.data[index,:]).flatten()
-        else:
-            new.data = np.array(self.data[index,:])           
+        data = self.data[index,:]
+        view = np.may_share_memory(data, self.data)
+        if view and '_views' not in self.__dict__:
+            # Instances sharing a data buffer, shared with copies of self
+            self._views = weakref.WeakSet()
+        new = copy(self) # shares mask and nifti_masker with self
+        new.data = data
+        if view:
+            # Copy-on-write view into self.data, see _writeable_data()
+            new.data.flags.writeable = False
+            self._views.add(new)
         if not self.Y.empty:
             new.Y = self.Y.iloc[index]
+        else:
+            new.Y = pd.DataFrame()
         if self.X.size:
             if isinstance(self.X,pd.DataFrame):
                 new.X = self.X.iloc[index]
@@ -141,12 +216,16 @@ class Brain_Data(object):
     def __setitem__(self, index, value):
         if not isinstance(value,Brain_Data):
             raise ValueError('Make sure the value you are trying to set is a Brain_Data() instance.')
+        self._writeable_data()
         self.data[index,:] = value.data
+        # Y and X of indexed instances may be views, so never write through them
         if not value.Y.empty:
+            self.Y = self.Y.copy()
             self.Y.values[index] = value.Y
         if not value.X.empty:
             if self.X.shape[1] != value.X.shape[1]:
                 raise ValueError('Make sure self.X is the same size as value.X.')
+            self.X = self.X.copy()
             self.X.values[index] = value.X
 
     def __len__(self):
@@ -173,8 +252,13 @@ class Brain_Data(object):
         
         """ 
 
-        out = deepcopy(self)
-        out.data = np.mean(out.data, axis=0)
+        out = self.empty()
+        if self.data.ndim == 1:
+            out.data = self._cast(np.mean(self.data, axis=0, dtype=np.float64))
+        else:
+            out.data = np.empty(self.data.shape[1], dtype=self.dtype)
+            for sl in self._chunks(axis=1):
+                out.data[sl] = np.mean(self.data[:,sl], axis=0, dtype=np.float64)
         return out
 
     def std(self):
@@ -188,33 +272,206 @@ class Brain_Data(object):
         
         """ 
 
-        out = deepcopy(self)
-        out.data = np.std(out.data, axis=0)
+        out = self.empty()
+        if self.data.ndim == 1:
+            out.data = self._cast(np.std(self.data, axis=0, dtype=np.float64))
+        else:
+            out.data = np.empty(self.data.shape[1], dtype=self.dtype)
+            for sl in self._chunks(axis=1):
+                out.data[sl] = np.std(self.data[:,sl], axis=0, dtype=np.float64)
         return out
 
-    def to_nifti(self):
+    @classmethod
+    def running_stats(cls, data, mask=None, stats=None, batch_size=None, n_jobs=1):
+        """ Accumulate voxelwise statistics over images in a single pass.
+
+        Images are read and summarized one block at a time, so collections
+        much larger than memory can be described.  The returned accumulator
+        can be merged with accumulators of other images (e.g. computed by
+        other processes) and turned into maps with from_running_stats.
+
+        Args:
+            data: Brain_Data instance, or list of file names, nibabel and/or
+                  Brain_Data instances
+            mask: mask used to load files (default: MNI152 2mm)
+            stats: RunningStats to add the images to (default: new accumulator)
+            batch_size: number of files loaded at a time
+            n_jobs: number of threads used to load each batch of files
+
+        Returns:
+            stats: nltools.stats.RunningStats instance
+
+        """
+
+        if stats is None:
+            stats = RunningStats()
+        if isinstance(data, Brain_Data):
+            data = [data]
+        elif not isinstance(data, list):
+            raise ValueError('data must be a Brain_Data instance or a list of images.')
+        nifti_masker = get_masker(load_mask(mask))
+        if batch_size is None:
+            n_voxels = int(nifti_masker.mask_img_.get_data().astype(bool).sum())
+            batch_size = max(1, cls.chunk_size // n_voxels)
+
+        images = []
+        for i, item in enumerate(data):
+            if isinstance(item, Brain_Data):
+                for sl in item._chunks(axis=0):
+                    stats.update(np.atleast_2d(item.data)[sl])
+            else:
+                images.append(item)
+            if images and (len(images) == batch_size or i == len(data) - 1):
+                stats.update(_load_images(images, nifti_masker, n_jobs=n_jobs))
+                images = []
+        return stats
+
+    @classmethod
+    def from_running_stats(cls, stats, mask=None):
+        """ Convert accumulated statistics into maps.
+
+        Args:
+            stats: nltools.stats.RunningStats instance
+            mask: mask of the accumulated images (default: MNI152 2mm)
+
+        Returns:
+            out: dictionary of Brain_Data maps {'mean','var','std','t','p','min','max','count'}
+
+        """
+
+        out = {}
+        for key, value in six.iteritems(stats.summary()):
+            out[key] = cls(mask=mask)
+            if len(value) != out[key].nifti_masker.mask_img_.get_data().astype(bool).sum():
+                raise ValueError('Statistics do not match the number of voxels in mask.')
+            out[key].data = value if key == 'count' else out[key]._cast(value)
+        return out
+
+    def to_nifti(self, file_name=None):
         """ Convert Brain_Data Instance into Nifti Object
 
+        Masked data are scattered into a preallocated volume with cached
+        voxel indices of the mask.  With an uncompressed (.nii) file_name the
+        volume is written directly to a memory-mapped file, one block of
+        images at a time.
+
         Args:
             self: Brain_Data instance
+            file_name: optionally write the image to this file
 
         Returns:
             out: nibabel instance
         
         """
-        
-        return self.nifti_masker.inverse_transform(self.data)
 
-    def write(self, file_name=None):
+        mask = self.nifti_masker.mask_img
+        shape = mask.shape[:3] + self.data.shape[:-1]
+        dtype = np.float64 if sparse.issparse(self.data) else self.data.dtype
+        if file_name is not None and file_name.endswith('.nii'):
+            return _write_nifti(self, file_name, shape, dtype)
+
+        data = self.data.tocoo() if sparse.issparse(self.data) else np.atleast_2d(self.data)
+        out = np.zeros((data.shape[0], np.prod(mask.shape[:3])), dtype=dtype)
+        index = get_mask_indices(mask)
+        if sparse.issparse(self.data):
+            # Scatter the non-zero values without densifying the masked data
+            out[data.row, index[data.col]] = data.data
+        else:
+            for sl in self._chunks(axis=0):
+                out[sl, index] = data[sl]
+        out = out.reshape((-1,) + mask.shape[:3]).transpose(1, 2, 3, 0).reshape(shape)
+        out = nib.Nifti1Image(out, affine=mask.affine)
+        if file_name is not None:
+            out.to_filename(file_name)
+        return out
+
+    def write(self, file_name=None, n_jobs=1):
         """ Write out Brain_Data object to Nifti File.
 
         Args:
             self: Brain_Data instance
-            file_name: name of nifti file
+            file_name: name of nifti file, or a list of file names to write
+                       one file per image
+            n_jobs: number of files written in parallel
 
         """
 
-        self.to_nifti().to_filename(file_name)
+        if file_name is None:
+            raise ValueError('Make sure to specify a file_name.')
+        if isinstance(file_name, (list, tuple)):
+            if len(file_name) != len(self):
+                raise ValueError('Make sure there is one file name per image.')
+            Parallel(n_jobs=n_jobs, backend='threading')(
+                delayed(_write_image)(self, i, name) for i, name in enumerate(file_name))
+        else:
+            self.to_nifti(file_name)
+
+    def save(self, file_name, mask_reference=False):
+        """ Save Brain_Data object in a fast native format.
+
+        Only the masked data are stored, as an uncompressed .npy file that can
+        be memory-mapped and partially read by Brain_Data.load().  The mask is
+        stored once alongside the data, or by reference to its file.
+
+        Args:
+            self: Brain_Data instance
+            file_name: name of directory to write
+            mask_reference: store the file name of the mask instead of a copy
+
+        """
+
+        if not os.path.isdir(file_name):
+            os.makedirs(file_name)
+        np.save(os.path.join(file_name, 'data.npy'), self.data)
+        mask_img = self.nifti_masker.mask_img
+        meta = {'Y':self.Y, 'X':self.X, 'dtype':np.dtype(self.dtype).str,
+                'file_name':self.file_name, 'mask_hash':get_mask_hash(mask_img),
+                'mask_file':None}
+        if (mask_reference and self.mask.get_filename() is not None and
+                get_mask_hash(self.mask) == meta['mask_hash']):
+            meta['mask_file'] = os.path.abspath(self.mask.get_filename())
+        else:
+            # Write a new image; to_filename() would rename the cached mask
+            nib.Nifti1Image(mask_img.get_data(), mask_img.affine, mask_img.header).to_filename(
+                os.path.join(file_name, 'mask.nii.gz'))
+        with open(os.path.join(file_name, 'meta.pkl'), 'wb') as f:
+            cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file_name, mmap_mode=None, index=None):
+        """ Load Brain_Data object written by Brain_Data.save().
+
+        Args:
+            file_name: name of directory written by save()
+            mmap_mode: memory-map the data instead of reading it (e.g., 'r' or 'r+');
+                       voxels are then only read from disk when accessed
+            index: rows (images) to load (default: all)
+
+        Returns:
+            out: Brain_Data instance
+
+        """
+
+        with open(os.path.join(file_name, 'meta.pkl'), 'rb') as f:
+            meta = cPickle.load(f)
+        if meta['mask_file'] is not None:
+            mask = load_mask(meta['mask_file'])
+            if get_mask_hash(mask) != meta['mask_hash']:
+                raise ValueError("Mask %s has changed since the data were saved." % meta['mask_file'])
+        else:
+            mask = load_mask(os.path.join(file_name, 'mask.nii.gz'))
+
+        out = cls(mask=mask, dtype=meta['dtype'])
+        # Always map the file so that only the requested rows are read
+        out.data = np.load(os.path.join(file_name, 'data.npy'), mmap_mode=mmap_mode or 'r')
+        out.Y = meta['Y']
+        out.X = meta['X']
+        out.file_name = meta['file_name']
+        if index is not None:
+            out = out[index]
+        if mmap_mode is None:
+            out.data = np.array(out.data)
+        return out
 
     def plot(self, limit=5, anatomical=None):
         """ Create a quick plot of self.data.  Will plot each image separately
@@ -235,77 +492,190 @@ class Brain_Data(object):
             anatomical = get_anatomical()
 
     
-        if self.data.ndim == 1:
+        if sparse.issparse(self.data):
+            # Plot masks (e.g., expand_mask(sparse=True)) as one label image
+            values = self.data.tocoo()
+            labels = np.array(self.Y).flatten() if len(self.Y) == self.data.shape[0] else np.arange(1, self.data.shape[0] + 1)
+            label_map = np.zeros(self.data.shape[1])
+            label_map[values.col] = labels[values.row]
+            plot_roi(self.nifti_masker.inverse_transform(label_map), anatomical, cut_coords=range(-40, 50, 10),
+                display_mode='z', black_bg=True, draw_cross=False)
+        elif self.data.ndim == 1:
             plot_stat_map(self.to_nifti(), anatomical, cut_coords=range(-40, 50, 10), display_mode='z', 
                 black_bg=True, colorbar=True, draw_cross=False)
         else:
-            for i in xrange(self.data.shape[0]):
-                if i < limit:
-                    # plot_roi(self.nifti_masker.inverse_transform(self.data[i,:]), self.anatomical)
-                    # plot_stat_map(self.nifti_masker.inverse_transform(self.data[i,:]), 
-                    plot_stat_map(self[i].to_nifti(), anatomical, cut_coords=range(-40, 50, 10), display_mode='z', 
-                        black_bg=True, colorbar=True, draw_cross=False)
+            img = self[:limit].to_nifti()
+            for i in xrange(min(limit, self.data.shape[0])):
+                plot_stat_map(index_img(img, i), anatomical, cut_coords=range(-40, 50, 10), display_mode='z', 
+                    black_bg=True, colorbar=True, draw_cross=False)
 
-    def regress(self):
+    def regress(self, residual=False, sigma=True, contrasts=None, X=None, n_permute=0, random_state=None,
+                n_jobs=1, cluster_dict=None):
         """ run vectorized OLS regression across voxels.
 
+        The design matrix is factored once and all voxels are fit in chunks
+        with a few matrix products. All outputs share self's mask and masker.
+        Several designs can be fit in the same pass over self.data and any
+        number of t and F contrasts are evaluated from each fit.
+
         Args:
             self: Brain_Data instance
+            residual: also return the residuals (as large as self.data)
+            sigma: also return the standard deviation of the residuals
+            contrasts: dictionary of {name: contrast}; a vector is a t contrast,
+                       a matrix (contrasts x regressors) is an F contrast. A
+                       contrast can also be a dictionary of {column: weight}.
+                       With a list of designs, one dictionary per design or
+                       a single dictionary used for all designs.
+            X: design matrix (pandas DataFrame) or list of design matrices;
+               defaults to self.X
+            n_permute: number of permutations (sign flips for constant
+                       regressors) of residuals used for family-wise error
+                       corrected p-values of each regressor (max-T, see
+                       nltools.stats.permutation_max_t); 0 skips the
+                       permutation test
+            random_state: seed or np.random.RandomState for the permutations
+            n_jobs: number of threads for the permutation test
+            cluster_dict: cluster level inference of each regressor from the
+                          same number of permutations (see ttest)
 
         Returns:
-            out: dictionary of regression statistics in Brain_Data instances {'beta','t','p','df','residual'}
+            out: dictionary of regression statistics in Brain_Data instances {'beta','t','p','df'[,'sigma','residual','p_fwe','p_cluster','tfce','p_tfce','contrasts']}
+                 contrasts: {name: {'estimate','se','t','p'}} for t contrasts
+                 and {name: {'estimate','F','p','df'}} for F contrasts.
+                 A list of dictionaries if X is a list.
         
         """ 
 
-        if not isinstance(self.X, pd.DataFrame):
-            raise ValueError('Make sure self.X is a pandas DataFrame.')
+        designs = X if isinstance(X, list) else [self.X if X is None else X]
+        if not isinstance(contrasts, list):
+            contrasts = [contrasts]*len(designs)
+        if len(contrasts) != len(designs):
+            raise ValueError('Make sure there is one dictionary of contrasts per design.')
+
+        # Statistics are accumulated in float64 and stored as self.dtype
+        fits = []
+        for design, design_contrasts in zip(designs, contrasts):
+            if not isinstance(design, pd.DataFrame):
+                raise ValueError('Make sure self.X is a pandas DataFrame.')
+            if design.empty:
+                raise ValueError('Make sure self.X is not empty.')
+            if self.data.shape[0]!= design.shape[0]:
+                raise ValueError("self.X does not match the correct size of self.data")
+            fits.append(self._regress_outputs(ols_factor(design), design, design_contrasts, residual, sigma))
+
+        for sl in self._chunks(axis=1):
+            Y = np.asarray(self.data[:,sl], dtype=np.float64)
+            for factor, out, design_contrasts in fits:
+                fit = ols_fit(factor, Y, residual=residual)
+                for k in out:
+                    if k not in ['df', 'contrasts']:
+                        out[k].data[...,sl] = fit[k]
+                for name, c in six.iteritems(design_contrasts):
+                    con = ols_contrast(factor, fit, c)
+                    for k in con:
+                        out['contrasts'][name][k].data[...,sl] = con[k]
+
+        if n_permute:
+            random_state = check_random_state(random_state)
+            for factor, out, design_contrasts in fits:
+                max_t = permutation_max_t(self.data, factor, n_permute=n_permute, random_state=random_state,
+                                          n_jobs=n_jobs, chunk_size=self.chunk_size)
+                out['p_fwe'] = self.empty()
+                out['p_fwe'].data = self._cast(fwe_p(out['t'].data, max_t))
+                if cluster_dict is not None:
+                    out.update(self._cluster_inference(out['t'].data, factor, cluster_dict, n_permute, random_state, n_jobs))
+        elif cluster_dict is not None:
+            raise ValueError('Set n_permute for cluster level inference.')
+
+        out = [i[1] for i in fits]
+        return out if isinstance(X, list) else out[0]
+
+    def _regress_outputs(self, factor, design, contrasts, residual, sigma):
+        """ Allocate the outputs of regress for a single design.
 
-        if self.X.empty:
-            raise ValueError('Make sure self.X is not empty.')
-
-        if self.data.shape[0]!= self.X.shape[0]:
-            raise ValueError("self.X does not match the correct size of self.data")
-
-        b = np.dot(np.linalg.pinv(self.X), self.data)
-        res = self.data - np.dot(self.X,b)
-        sigma = np.std(res,axis=0)
-        stderr = np.dot(np.matrix(np.diagonal(np.linalg.inv(np.dot(self.X.T,self.X)))**.5).T,np.matrix(sigma))
-        b_out = deepcopy(self)
-        b_out.data = b
-        t_out = deepcopy(self)
-        t_out.data = b /stderr
-        df = np.array([self.X.shape[0]-self.X.shape[1]] * t_out.data.shape[1])
-        p_out = deepcopy(self)
-        p_out.data = 2*(1-t.cdf(np.abs(t_out.data),df))
-
- 
-        # Might want to not output this info
-        df_out = deepcopy(self)
-        df_out.data = df
-        sigma_out = deepcopy(self)
-        sigma_out.data = sigma
-        res_out = deepcopy(self)
-        res_out.data = res
+        Returns:
+            factor, out, contrasts (as arrays)
 
-        return {'beta':b_out, 't':t_out, 'p':p_out, 'df':df_out, 'sigma':sigma_out, 'residual':res_out}
+        """
 
-    def ttest(self, threshold_dict=None):
+        n_voxels = self.data.shape[1]
+        shape = (design.shape[1], n_voxels)
+        out = {}
+        for k in ['beta', 't', 'p'] + ['sigma']*sigma:
+            out[k] = self.empty()
+            out[k].data = np.empty(shape if k != 'sigma' else n_voxels, dtype=self.dtype)
+        if residual:
+            out['residual'] = self.empty()
+            out['residual'].data = _empty_like(self.data)
+        out['df'] = self.empty()
+        out['df'].data = np.array([factor['df']] * n_voxels)
+
+        arrays = {}
+        if contrasts is not None:
+            out['contrasts'] = {}
+            for name, c in six.iteritems(contrasts):
+                if isinstance(c, dict):
+                    c = np.array([c.get(col, 0) for col in design.columns], dtype=np.float64)
+                c = np.asarray(c, dtype=np.float64)
+                if c.ndim not in [1, 2] or c.shape[-1] != design.shape[1]:
+                    raise ValueError("Contrast '%s' does not match the number of regressors." % name)
+                arrays[name] = c
+                keys = ['estimate', 'se', 't', 'p'] if c.ndim == 1 else ['estimate', 'F', 'p']
+                out['contrasts'][name] = {}
+                for k in keys:
+                    out['contrasts'][name][k] = self.empty()
+                    out['contrasts'][name][k].data = np.empty(c.shape[:-1] + (n_voxels,) if k == 'estimate' else n_voxels, dtype=self.dtype)
+                if c.ndim == 2:
+                    out['contrasts'][name]['df'] = (c.shape[0], factor['df'])
+        return factor, out, arrays
+
+    def ttest(self, threshold_dict=None, n_permute=0, random_state=None, n_jobs=1, cluster_dict=None):
         """ Calculate one sample t-test across each voxel (two-sided)
 
         Args:
             self: Brain_Data instance
-            threshold_dict: a dictionary of threshold parameters {'unc':.001} or {'fdr':.05}
+            threshold_dict: a dictionary of threshold parameters {'unc':.001}, {'fdr':.05} or {'fwe':.05}
+            n_permute: number of sign flips used for family-wise error corrected
+                       p-values (max-T); 0 skips the permutation test
+            random_state: seed or np.random.RandomState for the sign flips
+            n_jobs: number of threads for the permutation test
+            cluster_dict: cluster level inference from the same number of
+                          sign flips; {'extent':3.} for cluster extent with a
+                          cluster forming |t| threshold or {'tfce':True} (or a
+                          dictionary of {'E','H','dh'}) for TFCE. Optionally
+                          {'connectivity':26} (6, 18 or 26).
 
         Returns:
-            out: dictionary of regression statistics in Brain_Data instances {'t','p'}
+            out: dictionary of regression statistics in Brain_Data instances {'t','p'[,'p_fwe','p_cluster','tfce','p_tfce']}
         
         """ 
 
         # Notes:  Need to add FDR Option
 
-        t = deepcopy(self)
-        p = deepcopy(self)
-        t.data, p.data = ttest_1samp(self.data, 0, 0)
+        t = self.empty()
+        p = self.empty()
+        if self.data.ndim == 1:
+            t.data, p.data = [self._cast(x) for x in ttest_1samp(np.asarray(self.data, dtype=np.float64), 0, 0)]
+        else:
+            t.data = np.empty(self.data.shape[1], dtype=self.dtype)
+            p.data = np.empty(self.data.shape[1], dtype=self.dtype)
+            for sl in self._chunks(axis=1):
+                t.data[sl], p.data[sl] = ttest_1samp(np.asarray(self.data[:,sl], dtype=np.float64), 0, 0)
+
+        out = {'t':t, 'p':p}
+        if n_permute:
+            if self.data.ndim == 1:
+                raise ValueError('Permutation tests require more than one image.')
+            random_state = check_random_state(random_state)
+            max_t = permutation_max_t(self.data, n_permute=n_permute, random_state=random_state,
+                                      n_jobs=n_jobs, chunk_size=self.chunk_size)
+            out['p_fwe'] = self.empty()
+            out['p_fwe'].data = self._cast(fwe_p(t.data, max_t))
+            if cluster_dict is not None:
+                out.update(self._cluster_inference(t.data, None, cluster_dict, n_permute, random_state, n_jobs))
+        elif cluster_dict is not None:
+            raise ValueError('Set n_permute for cluster level inference.')
 
         if threshold_dict is not None:
             if type(threshold_dict) is dict:
@@ -314,64 +684,144 @@ class Brain_Data(object):
                     t.data[np.where(p.data>threshold_dict['unc'])] = np.nan
                 elif 'fdr' in threshold_dict:
                     pass
+                elif 'fwe' in threshold_dict:
+                    if 'p_fwe' not in out:
+                        raise ValueError("Set n_permute to threshold with {'fwe':.05}")
+                    t.data[np.where(out['p_fwe'].data>threshold_dict['fwe'])] = np.nan
             else:
                 raise ValueError("threshold_dict is not a dictionary.  Make sure it is in the form of {'unc':.001} or {'fdr':.05}")
 
-        out = {'t':t, 'p':p}
-
         return out
 
-    def append(self, data):
+    def append(self, data, inplace=False):
         """ Append data to Brain_Data instance
 
         Args:
             data: Brain_Data instance to append
+            inplace: append to self using growable buffers whose capacity
+                     doubles when full, so building a dataset one image at a
+                     time costs amortized O(1) per image
 
         Returns:
-            out: new appended Brain_Data instance
+            out: new appended Brain_Data instance (self if inplace)
         """
 
         if not isinstance(data, Brain_Data):
             raise ValueError('Make sure data is a Brain_Data instance')
- 
+
+        if inplace:
+            return self._append_inplace(data)
         if self.isempty():
-            out = deepcopy(data)           
-        else:
-            out = deepcopy(self)
-            if len(self.shape())==1 & len(data.shape())==1:
-                if self.shape()[0]!=data.shape()[0]:
-                    raise ValueError('Data is a different number of voxels then the weight_map.')
-            elif len(self.shape())==1 & len(data.shape())>1:
-                if self.shape()[0]!=data.shape()[1]:
-                    raise ValueError('Data is a different number of voxels then the weight_map.')
-            elif len(self.shape())>1 & len(data.shape())==1:
-                if self.shape()[1]!=data.shape()[0]:
-                    raise ValueError('Data is a different number of voxels then the weight_map.')
-            elif self.shape()[1]!=data.shape()[1]:
-                raise ValueError('Data is a different number of voxels then the weight_map.')
+            return deepcopy(data)
+        return Brain_Data.concat([self, data])
 
-            out.data = np.vstack([self.data,data.data])
-            if out.Y.size:
-                out.Y = self.Y.append(data.Y)
-            if self.X.size:
-                if isinstance(self.X,pd.DataFrame):
-                    out.X = self.X.append(data.X)
-                else:
-                    out.X = np.vstack([self.X, data.X])
+    @classmethod
+    def concat(cls, data):
+        """ Concatenate Brain_Data instances, allocating the output only once.
+
+        Args:
+            data: list of Brain_Data instances
+
+        Returns:
+            out: new concatenated Brain_Data instance
+
+        """
+
+        if not all([isinstance(i, Brain_Data) for i in data]):
+            raise ValueError('Make sure data is a list of Brain_Data instances')
+        data = [i for i in data if not i.isempty()]
+        if not data:
+            return cls()
+        rows = [np.atleast_2d(i.data) for i in data]
+        if len(set([i.shape[1] for i in rows])) > 1:
+            raise ValueError('Data is a different number of voxels then the weight_map.')
+
+        out = copy(data[0])
+        out.data = np.empty((sum([len(i) for i in rows]), rows[0].shape[1]), dtype=np.result_type(*rows))
+        start = 0
+        for i in rows:
+            out.data[start:start+len(i)] = i
+            start += len(i)
+        if data[0].Y.size:
+            out.Y = pd.concat([i.Y for i in data])
+        else:
+            out.Y = data[0].Y.copy()
+        if data[0].X.size:
+            if isinstance(data[0].X,pd.DataFrame):
+                out.X = pd.concat([i.X for i in data])
+            else:
+                out.X = np.vstack([i.X for i in data])
+        else:
+            out.X = data[0].X.copy()
         return out
 
+    def _append_inplace(self, data):
+        """ Append data to self using growable buffers (see append).
+
+        self.data, self.Y and self.X are views into buffers that are only
+        reallocated, with double the capacity, when they are full.
+
+        """
+
+        new_rows = np.atleast_2d(data.data)
+        if self.isempty():
+            n = 0
+        else:
+            n = np.atleast_2d(self.data).shape[0]
+            if np.atleast_2d(self.data).shape[1] != new_rows.shape[1]:
+                raise ValueError('Data is a different number of voxels then the weight_map.')
+
+        # Buffers are only reused by the instance that created them and only
+        # while its attributes are still the views handed out last time
+        buffers = getattr(self, '_append_buffers', None)
+        if (buffers is None or buffers['owner'] != id(self) or n == 0 or
+                buffers['data'] is None or not _is_buffer_view(self.data, buffers['data'])):
+            buffers = {'owner':id(self), 'data':None, 'Y':None, 'X':None}
+            if n:
+                buffers['data'] = _reserve(np.atleast_2d(self.data), n, 0)
+        buffers['data'] = _reserve(buffers['data'], n, len(new_rows), new_rows)
+        buffers['data'][n:n+len(new_rows)] = new_rows
+        self.data = buffers['data'][:n+len(new_rows)]
+
+        for attr in ['Y', 'X']:
+            value, new_value = getattr(self, attr), getattr(data, attr)
+            if (n and not np.size(value)) or not np.size(new_value):
+                continue
+            new_values = np.asarray(new_value).reshape(len(new_rows), -1)
+            buf = buffers[attr]
+            if buf is None or buf['view'] is not value:
+                buf = {'columns':getattr(value if n else new_value, 'columns', None), 'values':None}
+                if n:
+                    buf['values'] = _reserve(np.asarray(value).reshape(n, -1), n, 0)
+            buf['values'] = _reserve(buf['values'], n, len(new_rows), new_values)
+            buf['values'][n:n+len(new_rows)] = new_values
+            if buf['columns'] is not None:
+                buf['view'] = pd.DataFrame(buf['values'][:n+len(new_rows)], columns=buf['columns'], copy=False)
+            else:
+                buf['view'] = buf['values'][:n+len(new_rows)]
+            buffers[attr] = buf
+            setattr(self, attr, buf['view'])
+        self._append_buffers = buffers
+        return self
+
     def empty(self, data=True, Y=True, X=True):
         """ Initalize Brain_Data.data as empty
         
         """
         
-        tmp = deepcopy(self)
+        tmp = copy(self)
         if data:
             tmp.data = np.array([])
+        else:
+            tmp.data = self.data.copy()
         if Y:
             tmp.Y = pd.DataFrame()
+        else:
+            tmp.Y = self.Y.copy()
         if X:
             tmp.X = np.array([])
+        else:
+            tmp.X = self.X.copy()
         # tmp.data = np.array([]).reshape(0,n_voxels)
         return tmp
 
@@ -388,6 +838,9 @@ class Brain_Data(object):
             else:
                 boolean = True
 
+        if sparse.issparse(self.data):
+            boolean = not (self.data.shape[0] and self.data.shape[1])
+
         if isinstance(self.data, list):
             if not self.data:
                 boolean = True
@@ -396,15 +849,277 @@ class Brain_Data(object):
         
         return boolean
 
+    def astype(self, dtype):
+        """ Convert data to a different data type.
+
+        Args:
+            dtype: data type (e.g., 'float32')
+
+        Returns:
+            out: Brain_Data instance with a copy of data whose data and
+                 derived images use dtype
+
+        """
+
+        out = copy(self)
+        out.dtype = np.dtype(dtype).type
+        if isinstance(self.data, np.memmap):
+            out.data = _memmap(self.data.shape, out.dtype)
+            if self.data.ndim == 1:
+                out.data[:] = self.data
+            else:
+                for sl in self._chunks(axis=0):
+                    out.data[sl] = self.data[sl]
+        else:
+            out.data = np.array(self.data, dtype=out.dtype)
+        return out
+
+    def _cast(self, data):
+        """ Convert an array to self.dtype without copying if possible. """
+
+        return np.asarray(data).astype(self.dtype, copy=False)
+
+    def to_shared_memory(self):
+        """ Store data in shared memory so worker processes on this machine
+            use one copy of it.
+
+        The data are written to a memory-mapped file in /dev/shm (or the
+        temporary directory if there is none or it has too little free
+        space).  Pickling the returned
+        instance (e.g., for joblib or multiprocessing workers) only sends the
+        file name, and workers map the same pages read-only.  Call close(),
+        or use the instance as a context manager, to release the shared
+        memory; it is also released once the instance is garbage collected.
+        Processes that have already mapped the data can keep using it.
+
+        Returns:
+            out: Brain_Data instance with data in shared memory
+
+        """
+
+        directory = None
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            stat = os.statvfs('/dev/shm')
+            if stat.f_bavail * stat.f_frsize >= self.data.nbytes + _SHARED_MEMORY_MARGIN:
+                directory = '/dev/shm'
+        fd, file_name = tempfile.mkstemp(suffix='.npy', prefix='nltools_', dir=directory)
+        os.close(fd)
+        shared_file = (os.getpid(), file_name)
+        _shared_files.add(shared_file)
+        try:
+            out = self.to_memmap(file_name)
+        except Exception:
+            _release_shared_file(shared_file)
+            raise
+        out._shared_memory = {'owner':id(out), 'file_name':file_name}
+        _shared_owners[shared_file] = weakref.ref(out, lambda ref: _release_shared_file(shared_file))
+        return out
+
+    def close(self):
+        """ Release the shared memory created by to_shared_memory().  Only the
+            instance returned by to_shared_memory() owns it; this does nothing
+            for other instances.
+
+        """
+
+        shared = self.__dict__.get('_shared_memory')
+        if shared is not None and shared['owner'] == id(self):
+            _release_shared_file((os.getpid(), shared['file_name']))
+            del self._shared_memory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def to_memmap(self, file_name=None):
+        """ Store data in an on-disk memory map rather than in memory.
+
+        Methods such as mean, std, ttest, regress, similarity and extract_roi
+        process memory-mapped data in blocks of chunk_size values.
+
+        Args:
+            file_name: name of .npy file to write (default: temporary file)
+
+        Returns:
+            out: Brain_Data instance with data backed by np.memmap
+
+        """
+
+        out = copy(self)
+        out.data = _memmap(self.data.shape, self.data.dtype, file_name)
+        if self.data.ndim == 1:
+            out.data[:] = self.data
+        else:
+            for sl in self._chunks(axis=0):
+                out.data[sl] = self.data[sl]
+        out.data.flush()
+        return out
+
+    def clusters(self, threshold=0, connectivity=26):
+        """ Label clusters of connected voxels with |data| > threshold.
+            Positive and negative voxels form separate clusters.  Labelling
+            works on the masked data with the mask's voxel adjacency graph.
+
+        Args:
+            threshold: cluster forming threshold
+            connectivity: 6, 18 or 26 neighbours
+
+        Returns:
+            out: Brain_Data instance of cluster labels (0 outside clusters)
+
+        """
+
+        adjacency = get_adjacency(self.nifti_masker.mask_img, connectivity)
+        out = self.empty()
+        out.data = np.array([cluster_labels(row, adjacency, threshold) for row in np.atleast_2d(self.data)])
+        if self.data.ndim == 1:
+            out.data = out.data[0]
+        return out
+
+    def _cluster_inference(self, stat, factor, cluster_dict, n_permute, random_state, n_jobs):
+        """ Cluster extent or TFCE p-values of t maps (see ttest and regress).
+
+        Returns:
+            out: dictionary of Brain_Data instances {'p_cluster'} or {'tfce','p_tfce'}
+
+        """
+
+        adjacency = get_adjacency(self.nifti_masker.mask_img, cluster_dict.get('connectivity', 26))
+        out = {}
+        if 'extent' in cluster_dict:
+            null = permutation_cluster(self.data, adjacency, factor, threshold=cluster_dict['extent'],
+                                       n_permute=n_permute, random_state=random_state,
+                                       n_jobs=n_jobs, chunk_size=self.chunk_size)
+            observed = np.array([cluster_extent(row, adjacency, cluster_dict['extent']) for row in np.atleast_2d(stat)])
+            p = fwe_p(observed, null)
+            p[observed == 0] = np.nan
+            key = 'p_cluster'
+        elif 'tfce' in cluster_dict:
+            params = cluster_dict['tfce'] if isinstance(cluster_dict['tfce'], dict) else {}
+            null = permutation_cluster(self.data, adjacency, factor, tfce=params,
+                                       n_permute=n_permute, random_state=random_state,
+                                       n_jobs=n_jobs, chunk_size=self.chunk_size)
+            observed = np.array([tfce(row, adjacency, **params) for row in np.atleast_2d(stat)])
+            p = fwe_p(observed, null)
+            out['tfce'] = self.empty()
+            out['tfce'].data = self._cast(observed.reshape(stat.shape))
+            key = 'p_tfce'
+        else:
+            raise ValueError("cluster_dict must contain 'extent' or 'tfce'")
+        out[key] = self.empty()
+        out[key].data = self._cast(p.reshape(stat.shape))
+        return out
+
+    def _roi_columns(self, rois):
+        """ Sparse ROI x voxel matrix of a Brain_Data with sparse data in the
+            columns of self.data.
+
+        """
+
+        mask, rois_mask = self.nifti_masker.mask_img, rois.nifti_masker.mask_img
+        if get_mask_hash(mask) == get_mask_hash(rois_mask):
+            return rois.data.tocsr()
+        index = get_mask_alignment(mask, rois_mask)
+        if index is None:
+            raise ValueError('Make sure the ROIs are on the same grid as self.')
+        shared = rois.data.tocsc()[:, index[1]].tocsr()
+        return sparse.csr_matrix((shared.data, index[0][shared.indices], shared.indptr),
+                                 shape=(shared.shape[0], self.data.shape[-1]))
+
+    def _align(self, other):
+        """ Data of self and other restricted to the voxels both masks share.
+
+        Masks on the same grid are aligned with cached column indices into
+        the masked data.  Otherwise both are masked with the intersection of
+        the masks through NIfTI images.
+
+        Returns:
+            data, other_data, index: index is a pair of column indices into
+                                     data and other_data, or None if data and
+                                     other_data are already aligned
+
+        """
+
+        mask, other_mask = self.nifti_masker.mask_img, other.nifti_masker.mask_img
+        if get_mask_hash(mask) == get_mask_hash(other_mask):
+            return self.data, other.data, None
+        index = get_mask_alignment(mask, other_mask)
+        if index is not None:
+            return self.data, other.data, index
+        new_mask = intersect_masks([mask, other_mask], threshold=1, connected=False)
+        new_nifti_masker = get_masker(new_mask)
+        return new_nifti_masker.transform(self.to_nifti()), new_nifti_masker.transform(other.to_nifti()), None
+
+    def _chunks(self, axis=1):
+        """ Split self.data into blocks of images (axis=0) or voxels (axis=1).
+
+        Data held in memory is processed as a single block.  A single image
+        (1-D data) is one image of all voxels.
+
+        Returns:
+            list of slices along axis
+
+        """
+
+        if self.data.ndim == 1:
+            return [slice(0, 1 if axis == 0 else self.data.shape[0])]
+        n = self.data.shape[axis]
+        if not isinstance(self.data, np.memmap):
+            return [slice(0, n)]
+        step = max(1, self.chunk_size // max(1, self.data.shape[1-axis]))
+        return [slice(i, min(i+step, n)) for i in range(0, n, step)]
+
+    def _writeable_data(self):
+        """ Make sure self.data can be modified in place.
+
+        Indexing returns instances whose data is a read-only view into the
+        parent's data.  The view is only copied when it is about to be mutated,
+        and views still sharing the parent's data are detached (copied) before
+        the parent is mutated.  Writeable memory-mapped data stays on disk and
+        is modified in place.
+
+        """
+
+        if isinstance(self.data, np.ndarray) and not self.data.flags.writeable:
+            self.data = np.array(self.data)
+        for view in list(self.__dict__.get('_views', [])):
+            if view is not self and np.may_share_memory(view.data, self.data):
+                view.data = np.array(view.data)
+
+    def detach(self):
+        """ Stop sharing data with instances created by indexing.
+
+        Indexing returns instances whose data are read-only views into
+        self.data.  Brain_Data methods copy them before either side is
+        modified, but direct in-place changes of self.data (e.g.,
+        dat.data *= 2) would also change those views; call detach() first.
+        Read-only data (e.g., of an indexed instance) is replaced by a
+        writeable copy.
+
+        Returns:
+            self
+
+        """
+
+        self._writeable_data()
+        return self
+
     def similarity(self, image, method='correlation'):
         """ Calculate similarity of Brain_Data() instance with single Brain_Data or Nibabel image
 
+            All image by map similarities are computed with one matrix product
+            of normalized data, in blocks of images when the data are large.
+
             Args:
                 self: Brain_Data instance of data to be applied
                 image: Brain_Data or Nibabel instance of weight map
+                method: 'correlation', 'dot_product', 'cosine' or 'spearman'
 
             Returns:
                 pexp: Outputs a vector of pattern expression values
+                      (maps x images if image has several maps)
 
         """
 
@@ -413,58 +1128,60 @@ class Brain_Data(object):
                 image = Brain_Data(image)
             else:
                 raise ValueError("Image is not a Brain_Data or nibabel instance")
+        if method not in ['correlation', 'dot_product', 'cosine', 'spearman']:
+            raise ValueError("method must be 'correlation', 'dot_product', 'cosine' or 'spearman'")
         dim = image.shape()
 
-        # Check to make sure masks are the same for each dataset and if not create a union mask
-        # This might be handy code for a new Brain_Data method
-        if np.sum(self.nifti_masker.mask_img.get_data()==1)!=np.sum(image.nifti_masker.mask_img.get_data()==1):
-            new_mask = intersect_masks([self.nifti_masker.mask_img, image.nifti_masker.mask_img], threshold=1, connected=False)
-            new_nifti_masker = NiftiMasker(mask_img=new_mask)
-            data2 = new_nifti_masker.fit_transform(self.to_nifti())
-            image2 = new_nifti_masker.fit_transform(image.to_nifti())
-        else:
-            data2 = self.data
-            image2 = image.data
-
+        # Compare the voxels shared by both masks
+        data2, image2, index = self._align(image)
 
         # Calculate pattern expression
-        if method is 'dot_product':
-            if len(image2.shape) > 1:
-                if image2.shape[0]>1:
-                    pexp = []
-                    for i in range(image2.shape[0]):
-                        pexp.append(np.dot(data2, image2[i,:]))
-                    pexp = np.array(pexp)
-                else:
-                    pexp = np.dot(data2, image2)
-            else:
-                pexp = np.dot(data2, image2)
-        elif method is 'correlation':
-            if len(image2.shape) > 1:
-                if image2.shape[0]>1:
-                    pexp = []
-                    for i in range(image2.shape[0]):
-                        pexp.append(pearson(image2[i,:], data2))
-                    pexp = np.array(pexp)
-                else:
-                    pexp = pearson(image2, data2)
-            else:
-                pexp = pearson(image2, data2)
-        return pexp
+        return _similarity(data2, image2, method, self.chunk_size, index)
 
-    def distance(self, method='euclidean', **kwargs):
+    def distance(self, method='euclidean', n_jobs=1, dtype=None, memmap=None, condensed=False, **kwargs):
         """ Calculate distance between images within a Brain_Data() instance.
 
+            Distances are computed in blocks of rows, so only the output and
+            one block per job are held in memory.  'euclidean', 'correlation'
+            and 'cosine' distances are computed from matrix products of the
+            data; other metrics use scikit-learn's pairwise_distances.
+
             Args:
                 self: Brain_Data instance of data to be applied
                 method: type of distance metric (can use any scikit learn or sciypy metric)
+                n_jobs: number of blocks of rows computed in parallel
+                dtype: dtype of the output (default: self.dtype)
+                memmap: write the output to a memory-mapped .npy file; a
+                        file name or True for a temporary file
+                condensed: return the upper triangle as a vector in the order
+                           of scipy.spatial.distance.squareform
 
             Returns:
-                dist: Outputs a 2D distance matrix.
+                dist: Outputs a 2D distance matrix (or condensed vector).
 
         """
 
-        return pairwise_distances(self.data, metric = method, n_jobs=1)
+        data = np.atleast_2d(self.data)
+        n = data.shape[0]
+        shape = (n*(n-1)//2,) if condensed else (n, n)
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        out = np.empty(shape, dtype=dtype) if memmap is None else _memmap(shape, dtype, memmap)
+
+        if method in ['euclidean', 'correlation', 'cosine']:
+            sums = np.empty(n)
+            sq = np.empty(n)
+            for sl in self._chunks(axis=0):
+                block = np.asarray(data[sl], dtype=np.float64)
+                sums[sl] = block.sum(axis=1)
+                sq[sl] = np.einsum('ij,ij->i', block, block)
+            stats = {'sums':sums, 'sq':sq, 'n_voxels':data.shape[1]}
+        else:
+            stats = None
+        step = max(1, self.chunk_size // n)
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(_distance_block)(data, out, start, min(start+step, n), method, stats, step, kwargs)
+            for start in range(0, n, step))
+        return out
 
 
     def multivariate_similarity(self, images, method='ols'):
@@ -487,31 +1204,23 @@ class Brain_Data(object):
             raise ValueError("Images are not a Brain_Data instance")
         dim = images.shape()
 
-        # Check to make sure masks are the same for each dataset and if not create a union mask
-        # This might be handy code for a new Brain_Data method
-        if np.sum(self.nifti_masker.mask_img.get_data()==1)!=np.sum(images.nifti_masker.mask_img.get_data()==1):
-            new_mask = intersect_masks([self.nifti_masker.mask_img, images.nifti_masker.mask_img], threshold=1, connected=False)
-            new_nifti_masker = NiftiMasker(mask_img=new_mask)
-            data2 = new_nifti_masker.fit_transform(self.to_nifti())
-            image2 = new_nifti_masker.fit_transform(images.to_nifti())
-        else:
-            data2 = self.data
-            image2 = images.data
+        # Compare the voxels shared by both masks
+        data2, image2, index = self._align(images)
+        if index is not None:
+            data2, image2 = _take_columns(data2, index[0]), _take_columns(image2, index[1])
 
         # Add intercept and transpose
         image2 = np.vstack((np.ones(image2.shape[1]),image2)).T
 
         # Calculate pattern expression
-        if method is 'ols':
-            b = np.dot(np.linalg.pinv(image2), data2)
-            res = data2 - np.dot(image2,b)
-            sigma = np.std(res,axis=0)
-            stderr = np.dot(np.matrix(np.diagonal(np.linalg.inv(np.dot(image2.T,image2)))**.5).T,np.matrix(sigma))
-            t_out = b /stderr
-            df = image2.shape[0]-image2.shape[1]
-            p = 2*(1-t.cdf(np.abs(t_out),df))
+        if method == 'ols':
+            factor = ols_factor(image2)
+            out = ols_fit(factor, data2, residual=True)
+            out['df'] = factor['df']
+        else:
+            raise ValueError("method must be 'ols'")
 
-        return {'beta':b, 't':t_out, 'p':p, 'df':df, 'sigma':sigma, 'residual':res}
+        return out
 
     def predict(self, algorithm=None, cv_dict=None, plot=True, **kwargs):
 
@@ -586,7 +1295,7 @@ class Brain_Data(object):
                         output['prob_xval'] = np.zeros(len(self.Y))
 
             for train, test in output['cv']:
-                predictor_cv.fit(self.data[train], self.Y.loc[train])
+                predictor_cv.fit(self.data[train], self.Y.iloc[train])
                 output['yfit_xval'][test] = predictor_cv.predict(self.data[test])
                 if predictor_settings['prediction_type'] == 'classification':
                     if predictor_settings['algorithm'] not in ['svm','ridgeClassifier','ridgeClassifierCV']:
@@ -642,148 +1351,222 @@ class Brain_Data(object):
 
         return output
 
-    def bootstrap(self, analysis_type=None, n_samples=10, save_weights=False, **kwargs):
-        """ Bootstrap various Brain_Data analaysis methods (e.g., mean, std, regress, predict).  Currently  
+    def bootstrap(self, analysis_type=None, n_samples=10, save_weights=False, random_state=None, n_jobs=1, **kwargs):
+        """ Bootstrap various Brain_Data analaysis methods (e.g., mean, std, regress, predict).
+
+        Mean and std are bootstrapped with matrix products of multinomial
+        resampling weights and the data.  Regress and predict replicates are
+        run in a pool of n_jobs processes, each with its own seed derived from
+        random_state, so results do not depend on n_jobs.  All methods keep
+        running moments of the bootstrap distribution instead of every sample.
 
         Args:
             analysis_type: Type of analysis to bootstrap (mean,std,regress,predict)
             n_samples: Number of samples to boostrap
+            save_weights: Return all bootstrap samples as output['samples']
+            random_state: int seed or np.random.RandomState instance
+            n_jobs: Number of processes used for regress and predict (-1 for all cores)
             **kwargs: Additional keyword arguments to pass to the analysis method
 
         Returns:
-            output: a dictionary of prediction parameters
+            output: a dictionary of bootstrap summary images {'Z','p','mean'}
 
         """
 
         # Notes:
         # might want to add options for [studentized, percentile, bias corrected, bias corrected accelerated] methods
-        # Regress method is pretty convoluted and slow, this should be optimized better.  
 
-        def summarize_bootstrap(sample):
-            """ Calculate summary of bootstrap samples
+        analysis_list = ['mean','std','regress','predict']
+        random_state = check_random_state(random_state)
+
+        if analysis_type in ['mean','std']:
+            return self._bootstrap_moments(analysis_type, n_samples, save_weights, random_state)
+        elif analysis_type not in analysis_list:
+            raise ValueError('The analysis_type you specified (%s) is not yet implemented.' % (analysis_type))
 
-            Args:
-                sample: Brain_Data instance of samples
+        if analysis_type == 'predict':
+            kwargs.setdefault('algorithm', 'ridge')
+            kwargs.setdefault('cv_dict', None)
+            kwargs['plot'] = False
 
-            Returns:
-                output: dictionary of Brain_Data summary images
-                
-            """
-
-            output = {}
-
-            # Calculate SE of bootstraps
-            wstd = sample.std()
-            wmean = sample.mean()
-            wz = deepcopy(wmean)
-            wz.data = wmean.data / wstd.data
-            wp = deepcopy(wmean)
-            wp.data = 2*(1-norm.cdf(np.abs(wz.data)))
-
-            # Create outputs
-            output['Z'] = wz
-            output['p'] = wp
-            output['mean'] = wmean
+        # One seed per replicate so results are reproducible for any n_jobs
+        seeds = random_state.randint(np.iinfo(np.int32).max, size=n_samples)
+        if analysis_type == 'regress':
+            shape = (self.X.shape[1], self.data.shape[1])
+        else:
+            shape = (self.data.shape[1],)
+        size = int(np.prod(shape))
+        n_workers = n_jobs if n_jobs > 0 else max(1, cpu_count() + 1 + n_jobs)
+        batch = max(1, self.chunk_size // size, n_workers)
+        if save_weights:
+            samples = np.empty((n_samples, size), dtype=self.dtype)
+        moments = RunningStats()
+        data = self
+        if n_jobs != 1 and not isinstance(self.data, np.memmap):
+            # Workers map one shared copy of the data instead of every task
+            # pickling (and joblib hashing) self.data
+            data = self.to_shared_memory()
+        try:
+            with Parallel(n_jobs=n_jobs) as parallel:
+                for start in range(0, n_samples, batch):
+                    # One task per worker for each batch of seeds
+                    blocks = np.array_split(seeds[start:start+batch], n_workers)
+                    stat = parallel(delayed(_bootstrap_replicates)(data, analysis_type, block, kwargs)
+                                    for block in blocks if len(block))
+                    stat = np.vstack(stat)
+                    moments.update(stat)
+                    if save_weights:
+                        samples[start:start+batch] = stat
+        finally:
+            if data is not self:
+                data.close()
+
+        if save_weights:
+            if analysis_type == 'regress':
+                # Stack samples of each regressor in turn
+                samples = samples.reshape((n_samples,) + shape).swapaxes(0, 1).reshape(-1, shape[-1])
+            return self._bootstrap_summary(moments, shape, samples)
+        return self._bootstrap_summary(moments, shape)
+
+    def _bootstrap_moments(self, analysis_type, n_samples, save_weights, random_state):
+        """ Vectorized bootstrap of mean or std (see bootstrap).
+
+        Each batch of bootstrap samples is a matrix of multinomial resampling
+        weights, drawn from random_state when the batch is processed, so all
+        samples in a batch are computed with a few matrix products.
+
+        """
+
+        n = self.data.shape[0]
+        n_voxels = self.data.shape[1]
+        batch = max(1, self.chunk_size // max(n_voxels, n))
+        if save_weights:
+            samples = np.empty((n_samples, n_voxels), dtype=self.dtype)
+        moments = RunningStats()
+        for start in range(0, n_samples, batch):
+            w = random_state.multinomial(n, [1./n]*n, size=min(batch, n_samples - start))/float(n)
+            stat = np.empty((w.shape[0], n_voxels))
+            for sl in self._chunks(axis=1):
+                x = np.asarray(self.data[:,sl], dtype=np.float64)
+                stat[:,sl] = np.dot(w, x)
+                if analysis_type == 'std':
+                    stat[:,sl] = np.sqrt(np.maximum(np.dot(w, x**2) - stat[:,sl]**2, 0))
+            moments.update(stat)
             if save_weights:
-                output['samples'] = sample
+                samples[start:start+batch] = stat
 
-            return output
+        if save_weights:
+            return self._bootstrap_summary(moments, (n_voxels,), samples)
+        return self._bootstrap_summary(moments, (n_voxels,))
 
-        analysis_list = ['mean','std','regress','predict']
-        
-        if analysis_type in analysis_list:
-            data_row_id = range(self.shape()[0])
-            sample = self.empty()
-            if analysis_type is 'regress': #initialize dictionary of empty betas
-                beta={}
-                for i in range(self.X.shape[1]):
-                    beta['b' + str(i)] = self.empty()
-            for i in range(n_samples):
-                this_sample = np.random.choice(data_row_id, size=len(data_row_id), replace=True) # gives sampled row numbers
-                if analysis_type is 'mean':
-                    sample = sample.append(self[this_sample].mean())
-                elif analysis_type is 'std':
-                    sample = sample.append(self[this_sample].std())
-                elif analysis_type is 'regress':
-                    out = self[this_sample].regress()
-                    # Aggegate bootstraps for each beta separately
-                    for i, b in enumerate(beta.iterkeys()):
-                        beta[b]=beta[b].append(out['beta'][i])
-                elif analysis_type is 'predict':
-                    if 'algorithm' in kwargs:
-                        algorithm = kwargs['algorithm']
-                        del kwargs['algorithm']
-                    else:
-                        algorithm='ridge'
-                    if 'cv_dict' in kwargs:
-                        cv_dict = kwargs['cv_dict']
-                        del kwargs['cv_dict']
-                    else:
-                        cv_dict=None
-                    if 'plot' in ['kwargs']:
-                        plot=kwargs['plot']
-                        del kwargs['plot']
-                    else:
-                        plot=False
-                    out = self[this_sample].predict(algorithm=algorithm,cv_dict=cv_dict, plot=plot,**kwargs)
-                    sample = sample.append(out['weight_map'])
-        else:
-            raise ValueError('The analysis_type you specified (%s) is not yet implemented.' % (analysis_type))
+    def _bootstrap_summary(self, moments, shape, samples=None):
+        """ Summarize running moments of bootstrap samples.
 
-        # Save outputs
-        if analysis_type is 'regress':
-            reg_out={}
-            for i, b in enumerate(beta.iterkeys()):
-                reg_out[b] = summarize_bootstrap(beta[b])
-            output = {}
-            for b in reg_out.iteritems():
-                for o in b[1].iteritems():
-                    if o[0] in output:
-                        output[o[0]] = output[o[0]].append(o[1])
-                    else:
-                        output[o[0]]=o[1]
-        else:
-            output = summarize_bootstrap(sample)
+        Args:
+            moments: RunningStats of samples
+            shape: shape of a single bootstrap sample
+            samples: optional array of all bootstrap samples
+
+        Returns:
+            output: dictionary of Brain_Data summary images {'Z','p','mean','samples'}
+
+        """
+
+        mean = moments.mean()
+        z = mean / moments.std(ddof=0)
+        output = {}
+        for key, value in [('mean', mean), ('Z', z), ('p', 2*(1-norm.cdf(np.abs(z))))]:
+            output[key] = self.empty()
+            output[key].data = self._cast(value.reshape(shape))
+        if samples is not None:
+            output['samples'] = self.empty()
+            output['samples'].data = samples
         return output
 
     def apply_mask(self, mask):
         """ Mask Brain_Data instance
 
+        Masks on the grid of self's mask select (and zero-fill) columns of
+        self.data with cached voxel indices, without building images.  Masks
+        on other grids are first resampled to self's grid.
+
         Args:
             mask: mask (Brain_Data or nifti object)
             
         """
 
         if isinstance(mask,Brain_Data):
-            mask = mask.to_nifti() # convert to nibabel
+            if sparse.issparse(mask.data):
+                # union of sparse masks (e.g., expand_mask(sparse=True))
+                in_mask = np.asarray(abs(mask.data).sum(axis=0)).flatten() != 0
+                mask = mask.nifti_masker.inverse_transform(in_mask.astype(float))
+            else:
+                mask = mask.to_nifti() # convert to nibabel
         if not isinstance(mask, nib.Nifti1Image):
-            if type(mask) is str:
-                if os.path.isfile(mask):
-                    mask = nib.load(mask)
-               # Check if mask need to be resampled into Brain_Data mask space
-                if not ((self.mask.get_affine()==mask.get_affine()).all()) & (self.mask.shape[0:3]==mask.shape[0:3]):
-                    mask = resample_img(mask,target_affine=self.mask.get_affine(),target_shape=self.mask.shape)
+            if type(mask) is str and os.path.isfile(mask):
+                mask = load_mask(mask)
             else:
                 raise ValueError("Mask is not a nibabel instance, Brain_Data instance, or a valid file name.")
 
-        masked = deepcopy(self)
-        nifti_masker = NiftiMasker(mask_img=mask)
-        masked.data = nifti_masker.fit_transform(self.to_nifti())
-        if len(self.data.shape) > 2:
-            masked.data = masked.data.squeeze()
+        # Check if mask need to be resampled into Brain_Data mask space
+        mask_img = self.nifti_masker.mask_img
+        if not np.allclose(mask_img.affine, mask.affine) or mask_img.shape[0:3] != mask.shape[0:3]:
+            grid = nib.Nifti1Image(np.ones(mask_img.shape[0:3], dtype=np.int8), affine=mask_img.affine)
+            operator = get_resampling_operator(mask, grid, interpolation='nearest')
+            mask = nib.Nifti1Image((np.diff(operator.indptr) > 0).reshape(mask_img.shape[0:3]).astype(np.int8),
+                                   affine=mask_img.affine)
+
+        masked = self.empty(Y=False, X=False)
+        nifti_masker = get_masker(mask)
+        index, new_index = get_mask_alignment(mask_img, nifti_masker.mask_img)
+        n_voxels = np.sum(nifti_masker.mask_img.get_data() != 0)
+        if len(new_index) == n_voxels:
+            # mask is within self's mask: select columns
+            masked.data = _take_columns(self.data, index)
+            if masked.data is self.data:
+                masked.data = self.data.copy()
+        else:
+            # voxels outside self's mask are zero
+            masked.data = np.zeros(self.data.shape[:-1] + (n_voxels,), dtype=self.data.dtype)
+            masked.data[..., new_index] = _take_columns(self.data, index)
         masked.nifti_masker = nifti_masker
         return masked
 
-    def resample(self, target):
+    def resample(self, target, interpolation='continuous'):
         """ Resample data into target space
 
+        A sparse interpolation operator from self's mask to the target mask is
+        built once (and cached), so all images are resampled with one sparse
+        matrix product.
+
         Args:
             self: Brain_Data instance
-            target: Brain_Data instance of target space
+            target: Brain_Data instance of target space (or target mask as a
+                    nibabel instance or file name)
+            interpolation: 'continuous' (trilinear) or 'nearest'
+
+        Returns:
+            out: Brain_Data instance in target space
         
         """ 
 
-        raise NotImplementedError()
+        if isinstance(target, Brain_Data):
+            mask, nifti_masker = target.mask, target.nifti_masker
+        else:
+            mask = load_mask(target)
+            nifti_masker = get_masker(mask)
+        operator = get_resampling_operator(self.nifti_masker.mask_img, nifti_masker.mask_img, interpolation)
+
+        out = self.empty(Y=False, X=False)
+        data = np.atleast_2d(self.data)
+        out.data = np.empty((data.shape[0], operator.shape[0]), dtype=self.dtype)
+        for sl in self._chunks(axis=0):
+            out.data[sl] = operator.dot(np.asarray(data[sl], dtype=np.float64).T).T
+        if self.data.ndim == 1:
+            out.data = out.data[0]
+        out.mask = mask
+        out.nifti_masker = nifti_masker
+        return out
 
     def searchlight(self, ncores, process_mask=None, parallel_out=None, radius=3, walltime='24:00:00', \
         email=None, algorithm='svr', cv_dict=None, kwargs={}):
@@ -801,7 +1584,8 @@ class Brain_Data(object):
 
         # make and store data we will need to access on the worker core level
         parallel_job.make_searchlight_masks()
-        cPickle.dump(parallel_job, open(os.path.join(parallel_out,"pbs_searchlight.pkl"), "w"))
+        with open(os.path.join(parallel_out,"pbs_searchlight.pkl"), "wb") as f:
+            cPickle.dump(parallel_job, f, cPickle.HIGHEST_PROTOCOL)
 
         #make core startup script (python)
         parallel_job.make_startup_script("core_startup.py")
@@ -820,33 +1604,63 @@ class Brain_Data(object):
     def extract_roi(self, mask, method='mean'):
         """ Extract activity from mask
 
+        The atlas is converted once (and cached) to a sparse label x voxel
+        matrix in self's masked space, so means of all ROIs for all images
+        are one sparse-dense product.
+
         Args:
-            mask: nibabel mask can be binary or numbered for different rois
-            method: type of extraction method (default=mean)    
+            mask: nibabel or Brain_Data mask can be binary or numbered for different rois
+            method: type of extraction method: 'mean' (default), 'median' or
+                    'pca' (first eigenvariate)
 
         Returns:
             out: mean within each ROI across images
         
         """
 
-        if not isinstance(mask, nib.Nifti1Image):
-            raise ValueError('Make sure mask is a nibabel instance')
-
-        if len(np.unique(mask.get_data())) == 2:
-            all_mask = Brain_Data(mask)
-            if method is 'mean':
-                out = np.mean(self.data[:,np.where(all_mask.data)].squeeze(),axis=1)
-        elif len(np.unique(mask.get_data())) > 2:
-            all_mask = expand_mask(mask)
-            out = []
-            for i in range(all_mask.shape()[0]):
-                if method is 'mean':
-                    out.append(np.mean(self.data[:,np.where(all_mask[i].data)].squeeze(),axis=1))
-            out = np.array(out)
-
+        if method not in ['mean', 'median', 'pca']:
+            raise ValueError("method must be 'mean', 'median' or 'pca'")
+        if isinstance(mask, Brain_Data) and sparse.issparse(mask.data):
+            # One ROI per row (e.g., expand_mask(sparse=True)), used as is
+            roi_matrix, binary = self._roi_columns(mask), False
+            labels = np.array(mask.Y).flatten() if len(mask.Y) == roi_matrix.shape[0] else np.arange(roi_matrix.shape[0])
+        else:
+            if isinstance(mask, Brain_Data):
+                mask = mask.to_nifti()
+            if not isinstance(mask, nib.Nifti1Image):
+                raise ValueError('Make sure mask is a nibabel instance')
+            labels, roi_matrix = get_roi_matrix(mask, self.nifti_masker.mask_img)
+            binary = len(np.unique(mask.get_data())) == 2
+            if binary:
+                # A single ROI of all non-zero voxels
+                if not np.any(labels != 0):
+                    raise ValueError('ROI does not overlap the mask of the data.')
+                roi_matrix, labels = roi_matrix[labels != 0], labels[labels != 0]
+        empty = np.diff(roi_matrix.indptr) == 0
+        if np.any(empty):
+            raise ValueError('ROI %s does not overlap the mask of the data.' %
+                             ', '.join([str(i) for i in labels[empty]]))
+        data = np.atleast_2d(self.data)
+        out = np.empty((roi_matrix.shape[0], data.shape[0]))
+        if method == 'mean':
+            counts = np.asarray(roi_matrix.sum(axis=1)).flatten()
+            weights = sparse.diags(1./counts, 0).dot(roi_matrix).tocsr()
+            for sl in self._chunks(axis=0):
+                out[:, sl] = weights.dot(np.asarray(data[sl]).T)
+        else:
+            for i in range(roi_matrix.shape[0]):
+                roi = np.asarray(data[:, roi_matrix.indices[roi_matrix.indptr[i]:roi_matrix.indptr[i+1]]], dtype=np.float64)
+                if method == 'median':
+                    out[i] = np.median(roi, axis=1)
+                else:
+                    out[i] = _first_eigenvariate(roi)
+        if binary:
+            out = out[0]
+        if self.data.ndim == 1:
+            out = out[..., 0]
         return out
 
-    def icc(self, icc_type='icc2'):
+    def icc(self, icc_type='icc2', subject_id=None, session_id=None):
         ''' Calculate intraclass correlation coefficient for data within Brain_Data class
         
         ICC Formulas are based on:
@@ -858,61 +1672,52 @@ class Brain_Data(object):
 
         Code modifed from nipype algorithms.icc
         https://github.com/nipy/nipype/blob/master/nipype/algorithms/icc.py
+
+        Mean squares are computed from row and column means of the two-way
+        layout, without building a design matrix.  With subject_id and
+        session_id, an ICC of subjects (rows) by sessions (columns) is
+        computed for every voxel.
         
         Args:
             icc_type: type of icc to calculate (icc: voxel random effect, icc2: voxel and column random effect, icc3: voxel and column fixed effect)
+            subject_id: subject of each image (array or column name of self.X)
+                        for a voxelwise ICC map
+            session_id: session of each image (array or column name of self.X)
+                        for a voxelwise ICC map
 
         Returns:
-            ICC: intraclass correlation coefficient
+            ICC: intraclass correlation coefficient (Brain_Data instance for a
+                 voxelwise ICC map)
 
         '''
-        
-        Y = self.data.T
-        [n, k] = Y.shape
-
-        # Degrees of Freedom
-        dfc = k - 1
-        dfe = (n - 1) * (k-1)
-        dfr = n - 1
-
-        # Sum Square Total
-        mean_Y = np.mean(Y)
-        SST = ((Y - mean_Y) ** 2).sum()
-
-        # create the design matrix for the different levels
-        x = np.kron(np.eye(k), np.ones((n, 1)))  # sessions
-        x0 = np.tile(np.eye(n), (k, 1))  # subjects
-        X = np.hstack([x, x0])
-
-        # Sum Square Error
-        predicted_Y = np.dot(np.dot(np.dot(X, np.linalg.pinv(np.dot(X.T, X))), X.T), Y.flatten('F'))
-        residuals = Y.flatten('F') - predicted_Y
-        SSE = (residuals ** 2).sum()
-
-        MSE = SSE / dfe
-
-        # Sum square column effect - between colums
-        SSC = ((np.mean(Y, 0) - mean_Y) ** 2).sum() * n
-        MSC = SSC / dfc / n
-        
-        # Sum Square subject effect - between rows/subjects
-        SSR = SST - SSC - SSE
-        MSR = SSR / dfr
 
+        if icc_type not in ['icc1', 'icc2', 'icc3']:
+            raise ValueError("icc_type must be 'icc1', 'icc2' or 'icc3'")
         if icc_type == 'icc1':
-            # ICC(2,1) = (mean square subject - mean square error) / (mean square subject + (k-1)*mean square error + k*(mean square columns - mean square error)/n)
-            # ICC = (MSR - MSRW) / (MSR + (k-1) * MSRW)
-            NotImplementedError("This method isn't implemented yet.")
-            
-        elif icc_type == 'icc2':
-            # ICC(2,1) = (mean square subject - mean square error) / (mean square subject + (k-1)*mean square error + k*(mean square columns - mean square error)/n)
-            ICC = (MSR - MSE) / (MSR + (k-1) * MSE + k * (MSC - MSE) / n)
-
-        elif icc_type =='icc3':
-            # ICC(3,1) = (mean square subject - mean square error) / (mean square subject + (k-1)*mean square error)
-            ICC = (MSR - MSE) / (MSR + (k-1) * MSE)
-
-        return ICC
+            raise NotImplementedError("This method isn't implemented yet.")
+
+        if subject_id is None and session_id is None:
+            return _icc(np.asarray(self.data, dtype=np.float64).T, icc_type)
+        if subject_id is None or session_id is None:
+            raise ValueError('Make sure both subject_id and session_id are provided.')
+
+        ids = [np.asarray(self.X[i]) if isinstance(i, six.string_types) else np.asarray(i)
+               for i in [subject_id, session_id]]
+        if any([len(i) != self.data.shape[0] for i in ids]):
+            raise ValueError('Make sure subject_id and session_id have a value for each image.')
+        (subjects, rows), (sessions, cols) = [np.unique(i, return_inverse=True) for i in ids]
+        cells = np.zeros((len(subjects), len(sessions)), dtype=int)
+        np.add.at(cells, (rows, cols), 1)
+        if np.any(cells != 1):
+            raise ValueError('Make sure there is exactly one image per subject and session.')
+
+        out = self.empty()
+        out.data = np.empty(self.data.shape[1], dtype=self.dtype)
+        for sl in self._chunks(axis=1):
+            Y = np.empty((len(subjects), len(sessions), sl.stop - sl.start))
+            Y[rows, cols] = self.data[:, sl]
+            out.data[sl] = _icc(Y, icc_type)
+        return out
 
 def threshold(stat, p, threshold_dict={'unc':.001}):
     """ Calculate one sample t-test across each voxel (two-sided)
@@ -920,7 +1725,8 @@ def threshold(stat, p, threshold_dict={'unc':.001}):
     Args:
         stat: Brain_Data instance of arbitrary statistic metric (e.g., beta, t, etc)
         p: Brain_data instance of p-values
-        threshold_dict: a dictionary of threshold parameters {'unc':.001} or {'fdr':.05}
+        threshold_dict: a dictionary of threshold parameters {'unc':.001}, {'fdr':.05}
+                        or {'fwe':.05} (with p_fwe from ttest or regress)
  
     Returns:
         out: Thresholded Brain_Data instance
@@ -938,6 +1744,387 @@ def threshold(stat, p, threshold_dict={'unc':.001}):
         out.data[p.data > threshold_dict['unc']] = np.nan
     elif 'fdr' in threshold_dict:
         out.data[p.data > threshold_dict['fdr']] = np.nan
+    elif 'fwe' in threshold_dict:
+        out.data[p.data > threshold_dict['fwe']] = np.nan
     return out
 
+def _load_images(images, nifti_masker, dtype=np.float64, memmap=None, n_jobs=1, verbose=False):
+    """ Load and mask a list of images into a single (n_images, n_voxels) array.
+
+    Files are decompressed and masked in a pool of threads, each writing its
+    rows straight into a preallocated array.  4D images contribute one row per
+    volume.
+
+    Args:
+        images: list of file names and/or nibabel instances
+        nifti_masker: fitted NiftiMasker used to mask each image
+        dtype: data type of array
+        memmap: .npy file name (or True for a temporary file) to load into
+        n_jobs: number of threads to use (-1 for all cores)
+        verbose: report progress
+
+    Returns:
+        out: array of masked data
+
+    """
+
+    n_rows = []
+    for img in images:
+        if isinstance(img,six.string_types):
+            shape = nib.load(img).shape # only reads the header
+        elif isinstance(img,nib.Nifti1Image):
+            shape = img.shape
+        else:
+            raise ValueError("data is not a nibabel instance")
+        n_rows.append(shape[3] if len(shape) > 3 else 1)
+    rows = np.concatenate([[0], np.cumsum(n_rows)])
+
+    n_voxels = int(nifti_masker.mask_img_.get_data().astype(bool).sum())
+    if memmap is not None:
+        out = _memmap((rows[-1], n_voxels), dtype, memmap)
+    else:
+        out = np.empty((rows[-1], n_voxels), dtype=dtype)
+
+    Parallel(n_jobs=n_jobs, backend='threading', verbose=10 if verbose else 0)(
+        delayed(_mask_image)(img, nifti_masker, out[rows[i]:rows[i+1]])
+        for i, img in enumerate(images))
+    if memmap is not None:
+        out.flush()
+    return out
+
+def _mask_image(img, nifti_masker, out):
+    """ Mask img (file name or nibabel instance) with a fitted nifti_masker
+        and write the result into out. """
+
+    if isinstance(img,six.string_types):
+        img = nib.load(img)
+    out[:] = nifti_masker.transform(img)
+
+def _bootstrap_replicates(data, analysis_type, seeds, kwargs):
+    """ Run regress or predict bootstrap replicates of data, one per seed.
+
+    Args:
+        data: Brain_Data instance
+        analysis_type: 'regress' or 'predict'
+        seeds: seeds used to draw each bootstrap sample
+        kwargs: keyword arguments for Brain_Data.predict
+
+    Returns:
+        out: (replicates x values) array of flattened beta images or weight maps
+
+    """
+
+    n = data.shape()[0]
+    out = []
+    for seed in seeds:
+        sample = data[np.random.RandomState(seed).choice(n, size=n, replace=True)]
+        if analysis_type == 'regress':
+            out.append(np.ravel(sample.regress()['beta'].data))
+        else:
+            out.append(np.ravel(sample.predict(**kwargs)['weight_map'].data))
+    return np.array(out, dtype=np.float64)
+
+def _reserve(buffer, n_rows, n_new, like=None):
+    """ Make room for n_new more rows after the first n_rows of buffer.
+
+    Capacity is doubled whenever the buffer is full, so repeatedly appending
+    rows costs amortized O(1) copies per row.
+
+    Args:
+        buffer: 2D array or None
+        n_rows: number of rows of buffer in use
+        n_new: number of rows to add
+        like: array of new rows, used for dtype and columns of a new buffer
+
+    Returns:
+        buffer: buffer or a larger copy of it
+
+    """
+
+    if buffer is not None and n_rows + n_new <= buffer.shape[0]:
+        return buffer
+    capacity = n_rows + n_new
+    if buffer is not None:
+        capacity = max(capacity, 2*buffer.shape[0])
+        dtype = buffer.dtype if like is None else np.result_type(buffer, like)
+        n_columns = buffer.shape[1]
+    else:
+        dtype = like.dtype
+        n_columns = like.shape[1]
+    out = np.empty((capacity, n_columns), dtype=dtype)
+    if buffer is not None:
+        out[:n_rows] = buffer[:n_rows]
+    return out
+
+def _is_buffer_view(data, buffer):
+    """ Check whether data is still the writeable view of the start of buffer. """
+
+    return (isinstance(data, np.ndarray) and data.ndim == 2 and data.flags.writeable and
+            data.shape[0] <= buffer.shape[0] and data.shape[1] == buffer.shape[1] and
+            data.__array_interface__['data'][0] == buffer.__array_interface__['data'][0])
+
+def _distance_block(data, out, start, stop, method, stats, step, kwargs):
+    """ Distances of rows start:stop of data to all rows from start on,
+        written to the full or condensed distance matrix out.
+
+    With stats (row sums and sums of squares) the distances are computed from
+    X[start:stop] X[start:]', accumulated over blocks of voxels.  Otherwise
+    they are computed for blocks of step rows of X[start:] at a time.
+
+    """
+
+    n = data.shape[0]
+    if stats is None:
+        dist = np.empty((stop - start, n - start))
+        rows = np.asarray(data[start:stop])
+        for j in range(start, n, step):
+            dist[:, j-start:j-start+step] = pairwise_distances(rows, np.asarray(data[j:j+step]),
+                                                               metric=method, **kwargs)
+    else:
+        gram = np.zeros((stop - start, n - start))
+        for i in range(0, data.shape[1], step):
+            gram += np.dot(np.asarray(data[start:stop, i:i+step], dtype=np.float64),
+                           np.asarray(data[start:, i:i+step], dtype=np.float64).T)
+        rows, cols = slice(start, stop), slice(start, n)
+        sq = stats['sq']
+        if method == 'euclidean':
+            dist = np.sqrt(np.maximum(sq[rows, np.newaxis] + sq[np.newaxis, cols] - 2*gram, 0))
+        elif method == 'cosine':
+            norm = np.sqrt(sq)
+            dist = 1 - gram/np.outer(norm[rows], norm[cols])
+        else:
+            mean = stats['sums']/stats['n_voxels']
+            norm = np.sqrt(sq - stats['n_voxels']*mean**2)
+            dist = 1 - (gram - stats['n_voxels']*np.outer(mean[rows], mean[cols]))/np.outer(norm[rows], norm[cols])
+        dist[np.arange(stop - start), np.arange(stop - start)] = 0
+    if out.ndim == 2:
+        out[start:stop, start:] = dist
+        out[start:, start:stop] = dist.T
+    else:
+        for row in range(start, stop):
+            first = row*n - row*(row + 1)//2
+            out[first:first + n - row - 1] = dist[row - start, row - start + 1:]
+
+def _first_eigenvariate(data):
+    """ First eigenvariate (images,) of an images x voxels array, scaled as
+        in SPM and signed to correlate positively with the mean. """
+
+    data = data - data.mean(axis=0)
+    u, s, v = np.linalg.svd(data, full_matrices=False)
+    sign = np.sign(np.sum(v[0])) or 1
+    return sign*u[:, 0]*s[0]/np.sqrt(data.shape[1])
+
+def _icc(Y, icc_type):
+    """ ICC of targets (rows) rated by raters (columns) from two-way ANOVA
+        mean squares, vectorized over any trailing axes of Y. """
+
+    n, k = Y.shape[:2]
+
+    # Degrees of Freedom
+    dfc = k - 1
+    dfe = (n - 1) * (k-1)
+    dfr = n - 1
+
+    # Sum Square Total, column (between columns) and row (between rows) effects
+    mean_Y = Y.mean(axis=(0, 1))
+    SST = ((Y - mean_Y) ** 2).sum(axis=(0, 1))
+    SSC = ((Y.mean(axis=0) - mean_Y) ** 2).sum(axis=0) * n
+    SSR = ((Y.mean(axis=1) - mean_Y) ** 2).sum(axis=0) * k
+
+    # Sum Square Error is the residual of the additive model
+    SSE = SST - SSC - SSR
+    MSE = SSE / dfe
+    MSC = SSC / dfc / n
+    MSR = SSR / dfr
+
+    if icc_type == 'icc2':
+        # ICC(2,1) = (mean square subject - mean square error) / (mean square subject + (k-1)*mean square error + k*(mean square columns - mean square error)/n)
+        return (MSR - MSE) / (MSR + (k-1) * MSE + k * (MSC - MSE) / n)
+    # ICC(3,1) = (mean square subject - mean square error) / (mean square subject + (k-1)*mean square error)
+    return (MSR - MSE) / (MSR + (k-1) * MSE)
+
+def _write_nifti(brain, file_name, shape, dtype):
+    """ Write brain.to_nifti() to an uncompressed NIfTI file through a memory
+        map, filling one block of images at a time.
+
+    Returns:
+        out: nibabel instance backed by the file
+
+    """
+
+    mask = brain.nifti_masker.mask_img
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_sform(mask.affine, code=1)
+    header.set_qform(mask.affine, code=1)
+    header.set_data_offset(352)
+    with open(file_name, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (352 - f.tell()))
+    out = np.memmap(file_name, dtype=header.get_data_dtype(), mode='r+', offset=352,
+                    shape=(int(np.prod(mask.shape[:3])), int(np.prod(shape[3:]))), order='F')
+    index = get_mask_indices(mask, order='F')
+    data = brain.data
+    if sparse.issparse(data):
+        data = data.tocsr()
+    elif data.ndim == 1:
+        data = data[np.newaxis]
+    for sl in brain._chunks(axis=0):
+        block = data[sl].toarray() if sparse.issparse(data) else data[sl]
+        out[index, sl] = block.T
+    out.flush()
+    del out
+    return nib.load(file_name)
+
+def _write_image(brain, i, file_name):
+    """ Write image i of brain to file_name. """
+
+    brain[i].to_nifti(file_name)
+
+def _mask_reference(mask):
+    """ Picklable reference to a mask: its absolute file name and hash, and
+        its packed voxels and affine in case the file cannot be used where
+        the reference is loaded. """
+
+    file_name = mask.get_filename()
+    in_mask = mask.get_data() != 0
+    return {'hash':get_mask_hash(mask),
+            'file_name':os.path.abspath(file_name) if file_name is not None else None,
+            'shape':in_mask.shape, 'affine':mask.affine, 'bits':np.packbits(in_mask)}
+
+def _load_mask_reference(reference):
+    """ Mask of a _mask_reference, shared with the process-wide mask caches.
+        The mask file is used if it still exists and is unchanged, otherwise
+        the mask is rebuilt from its packed voxels. """
+
+    file_name = reference['file_name']
+    if file_name is not None and os.path.isfile(file_name):
+        mask = load_mask(file_name)
+        if get_mask_hash(mask) == reference['hash']:
+            return mask
+    if 'bits' not in reference:
+        if file_name is None:
+            raise ValueError('Pickled mask is corrupted.')
+        raise ValueError("Mask file %s is missing or has changed since pickling" % file_name)
+    in_mask = np.unpackbits(reference['bits'])[:np.prod(reference['shape'])].reshape(reference['shape'])
+    mask = nib.Nifti1Image(in_mask.astype(np.int8), affine=reference['affine'])
+    if get_mask_hash(mask) != reference['hash']:
+        raise ValueError('Pickled mask is corrupted.')
+    return get_masker(mask).mask_img
+
+def _data_reference(data):
+    """ Picklable reference to data that is an entire memory-mapped file, or
+        data itself. """
+
+    if (isinstance(data, np.memmap) and data.filename is not None and os.path.exists(data.filename) and
+            (data.flags.c_contiguous or data.flags.f_contiguous) and
+            os.path.getsize(data.filename) == data.offset + data.nbytes):
+        return {'memmap':data.filename, 'offset':data.offset, 'dtype':data.dtype.str,
+                'shape':data.shape, 'order':'C' if data.flags.c_contiguous else 'F'}
+    return data
+
+def _load_data_reference(reference):
+    """ Data of a _data_reference; memory-mapped files are opened read-only. """
+
+    if isinstance(reference, dict) and 'memmap' in reference:
+        return np.memmap(reference['memmap'], dtype=np.dtype(reference['dtype']), mode='r',
+                         offset=reference['offset'], shape=reference['shape'], order=reference['order'])
+    return reference
+
+def _release_shared_file(shared_file):
+    """ Remove a shared memory file created by this process. """
+
+    pid, file_name = shared_file
+    _shared_owners.pop(shared_file, None)
+    if pid == os.getpid() and shared_file in _shared_files:
+        _shared_files.discard(shared_file)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+@atexit.register
+def _release_shared_files():
+    """ Remove shared memory files that were not closed. """
+
+    for shared_file in list(_shared_files):
+        _release_shared_file(shared_file)
+
+def _memmap(shape, dtype, file_name=None):
+    """ Create a writeable memory map stored as a .npy file.
+
+    Args:
+        shape: shape of array
+        dtype: data type of array
+        file_name: name of .npy file (default: temporary file that is removed
+                   once the memory map is closed)
+
+    Returns:
+        out: np.memmap instance
+
+    """
+
+    if file_name is None or file_name is True:
+        fd, tmp_name = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        out = np.lib.format.open_memmap(tmp_name, mode='w+', dtype=dtype, shape=shape)
+        os.remove(tmp_name)
+    else:
+        out = np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=shape)
+    return out
+
+def _empty_like(data):
+    """ Allocate an uninitialized array of the same shape as data, on disk if
+        data is memory-mapped. """
+
+    if isinstance(data, np.memmap):
+        return _memmap(data.shape, data.dtype)
+    return np.empty(data.shape, dtype=data.dtype)
+
+def _similarity(data, image, method, chunk_size, index=None):
+    """ Calculate similarity of each image in data with each image in image
+        with one matrix product per block of images of data.
+
+    Args:
+        data: (n_images, n_voxels) array (e.g., np.memmap)
+        image: (n_voxels,) or (n_maps, n_voxels) array
+        method: 'dot_product', 'correlation', 'cosine' or 'spearman'
+        chunk_size: number of values of data to process at a time
+        index: optional pair of column indices aligning data and image
+
+    Returns:
+        pexp: similarity values (n_maps, n_images), squeezed
+
+    """
+
+    if index is None:
+        index = (None, None)
+    data = np.atleast_2d(data)
+    maps = _normalize_rows(_take_columns(np.atleast_2d(image), index[1]), method)
+    pexp = np.empty((maps.shape[0], data.shape[0]))
+    step = max(1, chunk_size // data.shape[1])
+    for i in range(0, data.shape[0], step):
+        block = _take_columns(data[i:i+step], index[0])
+        pexp[:, i:i+step] = np.dot(maps, _normalize_rows(block, method).T)
+    return pexp.squeeze()
+
+def _take_columns(data, index):
+    """ Select columns (voxels) of data; index None or covering every column
+        of data returns data itself. """
+
+    if index is None or len(index) == data.shape[-1]:
+        return data
+    return np.take(data, index, axis=-1)
+
+def _normalize_rows(x, method):
+    """ Rank, center and/or scale rows of x so that their dot products are
+        the similarities of method. """
+
+    x = np.array(x, dtype=np.float64)
+    if method == 'spearman':
+        x = np.apply_along_axis(rankdata, 1, x)
+    if method in ['correlation', 'spearman']:
+        x -= x.mean(axis=1)[:, np.newaxis]
+    if method in ['correlation', 'spearman', 'cosine']:
+        x /= np.sqrt(np.einsum('ij,ij->i', x, x))[:, np.newaxis]
+    return x
 
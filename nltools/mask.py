@@ -5,19 +5,319 @@
 
 '''
 
-__all__ = ['create_sphere', 'expand_mask']
+__all__ = ['create_sphere', 'expand_mask', 'load_mask', 'get_masker', 'get_mask_hash',
+           'get_adjacency', 'get_mask_alignment', 'get_roi_matrix',
+           'get_resampling_operator', 'get_mask_indices']
 __author__ = ["Luke Chang", "Sam Greydanus"]
 __license__ = "MIT"
 
 import os
+import hashlib
+import weakref
+import itertools
 import nibabel as nib
-from nltools.utils import get_resource_path
+from nltools.utils import get_resource_path, LRUCache
 from nilearn.input_data import NiftiMasker
 from copy import deepcopy
 import pandas as pd
 import numpy as np
+from scipy import sparse
 # from neurosynth.masks import Masker
 
+# Process-wide caches shared by all Brain_Data instances, one LRUCache per
+# kind of object (see _cached), each keeping its _CACHE_SIZE most recently
+# used items
+_CACHE_SIZE = 16
+_caches = {}
+_mask_hashes = weakref.WeakKeyDictionary()
+
+def _cached(kind, key, compute):
+    """ Value of compute() memoized under key in the process-wide cache of
+        kind.  Keys hold the hashes of the masks the value is derived from
+        (or the file name, mtime and size of a mask file), so the cache is
+        shared by equal masks.  None is never cached.
+
+    """
+
+    cache = _caches.get(kind)
+    if cache is None:
+        cache = _caches.setdefault(kind, LRUCache(maxsize=_CACHE_SIZE))
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        if value is not None:
+            cache[key] = value
+    return value
+
+def load_mask(mask=None):
+    """ Load a mask image, reusing images that have already been loaded.
+
+        Args:
+            mask: file name or nibabel instance (default: MNI152 2mm brain mask)
+
+        Returns:
+            mask: nibabel instance
+
+    """
+
+    if mask is None:
+        mask = os.path.join(get_resource_path(),'MNI152_T1_2mm_brain_mask.nii.gz')
+    if isinstance(mask, nib.Nifti1Image):
+        return mask
+    if not (isinstance(mask, str) and os.path.isfile(mask)):
+        raise ValueError("mask is not a nibabel instance or a valid file name")
+    stat = os.stat(mask)
+    return _cached('mask', (os.path.abspath(mask), stat.st_mtime, stat.st_size),
+                   lambda: _load_mask_file(mask))
+
+def _load_mask_file(file_name):
+    """ Load a mask image that is shared by every caller, so its data are
+        read-only. """
+
+    img = nib.load(file_name)
+    img.get_data().flags.writeable = False
+    return img
+
+def get_mask_hash(mask):
+    """ Hash of the voxels and geometry of a mask.  Masks that select the
+        same voxels in the same space have the same hash.  Hashes are only
+        remembered for images with read-only data (e.g., those of load_mask
+        and get_masker), since other images may change in place.
+
+        Args:
+            mask: nibabel instance
+
+        Returns:
+            hash: hex string
+
+    """
+
+    data = mask.get_data()
+    cache = not data.flags.writeable
+    if cache:
+        try:
+            return _mask_hashes[mask]
+        except (KeyError, TypeError):
+            pass
+    sha = hashlib.sha1()
+    sha.update(np.asarray(data.shape[:3], dtype=np.int64).tobytes())
+    sha.update(np.asarray(mask.affine, dtype=np.float64).tobytes())
+    sha.update(np.packbits(np.ascontiguousarray(data != 0)).tobytes())
+    mask_hash = sha.hexdigest()
+    if cache:
+        try:
+            _mask_hashes[mask] = mask_hash
+        except TypeError:
+            pass
+    return mask_hash
+
+def get_masker(mask=None):
+    """ Get a fitted NiftiMasker for mask.  Maskers are cached by mask
+        content so masks with the same voxels share one NiftiMasker.  They
+        are fitted on a private binary copy of the mask, so later changes to
+        the caller's image do not reach the cache.
+
+        Args:
+            mask: file name or nibabel instance (default: MNI152 2mm brain mask)
+
+        Returns:
+            nifti_masker: fitted NiftiMasker instance
+
+    """
+
+    mask = load_mask(mask)
+
+    def fit():
+        data = (mask.get_data() != 0).astype(np.int8)
+        data.flags.writeable = False
+        return NiftiMasker(mask_img=nib.Nifti1Image(data, affine=mask.affine.copy())).fit()
+
+    return _cached('masker', get_mask_hash(mask), fit)
+
+def get_adjacency(mask=None, connectivity=26):
+    """ Sparse adjacency graph of the voxels in a mask.  Rows and columns
+        follow the order of the masked data (NiftiMasker.transform), so
+        clusters can be labelled without going back to 3D images.
+
+        Args:
+            mask: file name or nibabel instance (default: MNI152 2mm brain mask)
+            connectivity: 6 (faces), 18 (faces and edges) or 26 (faces, edges
+                          and corners)
+
+        Returns:
+            adjacency: scipy.sparse.csr_matrix (voxels x voxels)
+
+    """
+
+    if connectivity not in [6, 18, 26]:
+        raise ValueError('connectivity must be 6, 18 or 26')
+    mask = load_mask(mask)
+    return _cached('adjacency', (get_mask_hash(mask), connectivity),
+                   lambda: _adjacency(mask, connectivity))
+
+def _adjacency(mask, connectivity):
+    """ Adjacency graph of get_adjacency. """
+
+    in_mask = mask.get_data() != 0
+    shape = in_mask.shape[:3]
+    index = -np.ones(shape, dtype=np.int64)
+    index[in_mask.reshape(shape)] = np.arange(np.sum(in_mask))
+    rows, cols = [], []
+    for offset in itertools.product([-1, 0, 1], repeat=3):
+        distance = np.sum(np.abs(offset))
+        if distance == 0 or distance > {6:1, 18:2, 26:3}[connectivity]:
+            continue
+        src = index[tuple([slice(max(0, -o), n - max(0, o)) for o, n in zip(offset, shape)])]
+        dst = index[tuple([slice(max(0, o), n - max(0, -o)) for o, n in zip(offset, shape)])]
+        valid = (src >= 0) & (dst >= 0)
+        rows.append(src[valid])
+        cols.append(dst[valid])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                             shape=(len(index[index >= 0]),)*2)
+
+
+def get_mask_alignment(mask1, mask2):
+    """ Indices of the voxels shared by two masks in each mask's masked data,
+        so data masked with either mask can be compared without going back
+        to 3D images.
+
+        Args:
+            mask1: file name or nibabel instance
+            mask2: file name or nibabel instance
+
+        Returns:
+            index1, index2: read-only arrays of column indices into data masked
+                            with mask1 and mask2 selecting the shared voxels in
+                            the same order, or None if the masks are not on the
+                            same grid
+
+    """
+
+    mask1, mask2 = load_mask(mask1), load_mask(mask2)
+    return _cached('alignment', (get_mask_hash(mask1), get_mask_hash(mask2)),
+                   lambda: _alignment(mask1, mask2))
+
+def _alignment(mask1, mask2):
+    """ Shared voxel indices of get_mask_alignment. """
+
+    if mask1.shape[:3] != mask2.shape[:3] or not np.allclose(mask1.affine, mask2.affine):
+        return None
+    in_mask1 = mask1.get_data() != 0
+    in_mask2 = mask2.get_data() != 0
+    shared = in_mask1 & in_mask2
+    alignment = (np.flatnonzero(shared[in_mask1]), np.flatnonzero(shared[in_mask2]))
+    for index in alignment:
+        index.setflags(write=False)
+    return alignment
+
+
+def get_roi_matrix(rois, mask=None):
+    """ Sparse label x voxel matrix of a labelled atlas in the masked space of
+        mask, so values of all ROIs can be extracted with one sparse-dense
+        product.
+
+        Args:
+            rois: nibabel instance with an integer label per voxel
+            mask: file name or nibabel instance (default: MNI152 2mm brain mask)
+
+        Returns:
+            labels: sorted label values (including 0 if present in mask)
+            matrix: scipy.sparse.csr_matrix (labels x voxels) with a one for
+                    each voxel of each label
+
+    """
+
+    mask = load_mask(mask)
+    data = np.asarray(rois.get_data())
+    sha = hashlib.sha1()
+    sha.update(np.asarray(data.shape, dtype=np.int64).tobytes())
+    sha.update(np.asarray(rois.affine, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(data).tobytes())
+    return _cached('roi', (sha.hexdigest(), get_mask_hash(mask)),
+                   lambda: _label_matrix(get_masker(mask).transform(rois)[0].astype(int)))
+
+
+def get_resampling_operator(source, target, interpolation='continuous'):
+    """ Sparse interpolation operator from the voxels of a source mask to the
+        voxels of a target mask (in masked data order), so images masked with
+        source are resampled to target with one sparse matrix product.
+        Voxels outside the source mask count as zero.
+
+        Args:
+            source: file name or nibabel instance of the source mask
+            target: file name or nibabel instance of the target mask
+            interpolation: 'continuous' (trilinear) or 'nearest'
+
+        Returns:
+            operator: scipy.sparse.csr_matrix (target voxels x source voxels)
+
+    """
+
+    if interpolation not in ['continuous', 'nearest']:
+        raise ValueError("interpolation must be 'continuous' or 'nearest'")
+    source, target = load_mask(source), load_mask(target)
+    return _cached('resampling', (get_mask_hash(source), get_mask_hash(target), interpolation),
+                   lambda: _resampling_operator(source, target, interpolation))
+
+def _resampling_operator(source, target, interpolation):
+    """ Interpolation operator of get_resampling_operator. """
+
+    in_source = source.get_data() != 0
+    shape = in_source.shape[:3]
+    source_index = -np.ones(shape, dtype=np.int64)
+    source_index[in_source.reshape(shape)] = np.arange(np.sum(in_source))
+    ijk = np.array(np.nonzero(target.get_data() != 0)[:3])
+    transform = np.dot(np.linalg.inv(source.affine), target.affine)
+    coords = np.round(np.dot(transform[:3, :3], ijk) + transform[:3, 3:], 8)
+    if interpolation == 'nearest':
+        corners = [(np.round(coords).astype(np.int64), np.ones(ijk.shape[1]))]
+    else:
+        base = np.floor(coords).astype(np.int64)
+        frac = coords - base
+        corners = []
+        for offset in itertools.product([0, 1], repeat=3):
+            offset = np.array(offset)[:, np.newaxis]
+            weight = np.prod(np.where(offset, frac, 1 - frac), axis=0)
+            corners.append((base + offset, weight))
+    rows, cols, weights = [], [], []
+    for corner, weight in corners:
+        valid = np.all((corner >= 0) & (corner < np.array(shape)[:, np.newaxis]), axis=0) & (weight > 0)
+        index = -np.ones(ijk.shape[1], dtype=np.int64)
+        index[valid] = source_index[tuple(corner[:, valid])]
+        valid &= index >= 0
+        rows.append(np.flatnonzero(valid))
+        cols.append(index[valid])
+        weights.append(weight[valid])
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(ijk.shape[1], np.sum(in_source)))
+
+
+def get_mask_indices(mask=None, order='C'):
+    """ Flat indices of the voxels of a mask in masked data order, to scatter
+        masked data into volumes without NiftiMasker.inverse_transform.
+
+        Args:
+            mask: file name or nibabel instance (default: MNI152 2mm brain mask)
+            order: 'C' for indices into a C-ordered volume or 'F' for a
+                   Fortran-ordered volume (as stored in NIfTI files)
+
+        Returns:
+            index: read-only array of flat voxel indices
+
+    """
+
+    mask = load_mask(mask)
+    return _cached('indices', (get_mask_hash(mask), order), lambda: _mask_indices(mask, order))
+
+def _mask_indices(mask, order):
+    """ Flat voxel indices of get_mask_indices. """
+
+    index = np.ravel_multi_index(np.nonzero(mask.get_data() != 0)[:3], mask.shape[:3], order=order)
+    index.setflags(write=False)
+    return index
+
+
 
 def create_sphere(coordinates, radius=5, mask=None):
     """ Generate a set of spheres in the brain mask space
@@ -28,15 +328,7 @@ def create_sphere(coordinates, radius=5, mask=None):
 
     """
     
-    if mask is not None:
-        if not isinstance(mask,nib.Nifti1Image):
-            if type(mask) is str:
-                if os.path.isfile(mask):
-                    data = nib.load(mask)
-            else:
-                raise ValueError("mask is not a nibabel instance or a valid file name")
-    else:
-        mask = nib.load(os.path.join(get_resource_path(),'MNI152_T1_2mm_brain_mask.nii.gz'))
+    mask = load_mask(mask)
     dims = mask.get_data().shape
 
     def sphere(r, p, mask):
@@ -76,11 +368,13 @@ def create_sphere(coordinates, radius=5, mask=None):
     else:
         raise ValueError("Data type for sphere or radius(ii) or center(s) not recognized.")
 
-def expand_mask(mask):
+def expand_mask(mask, sparse=False):
     """ expand a mask with multiple integers into separate binary masks
 
         Args:
             mask: nibabel or Brain_Data instance
+            sparse: return the masks as a scipy.sparse.csr_matrix without a
+                    mask for label 0; Y holds the label of each mask
 
         Returns:
             out: Brain_Data instance of multiple binary masks
@@ -92,6 +386,12 @@ def expand_mask(mask):
         mask = Brain_Data(mask)
     if not isinstance(mask,Brain_Data):
         raise ValueError('Make sure mask is a nibabel or Brain_Data instance.')
+    if sparse:
+        labels, matrix = _label_matrix(np.asarray(mask.data).astype(int))
+        out = mask.empty()
+        out.data = matrix[labels != 0]
+        out.Y = pd.DataFrame(labels[labels != 0])
+        return out
     mask.data = mask.data.astype(int)
     tmp = []
     for i in np.unique(mask.data):
@@ -100,4 +400,18 @@ def expand_mask(mask):
     out.data = np.array(tmp)
     return out
 
+def _label_matrix(values):
+    """ Sparse label x voxel matrix of a vector of integer labels.
+
+        Returns:
+            labels: sorted label values
+            matrix: scipy.sparse.csr_matrix (labels x voxels) of ones
+
+    """
+
+    labels, rows = np.unique(values, return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(values), dtype=np.int8), (rows, np.arange(len(values)))),
+                               shape=(len(labels), len(values)))
+    return labels, matrix
+
 
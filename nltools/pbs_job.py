@@ -86,7 +86,7 @@ import cPickle \n\
 import os \n\
 import sys \n\
 pdir = \"" + os.path.join(self.parallel_out,'pbs_searchlight.pkl') + "\" \n\
-parallel_job = cPickle.load( open(pdir) ) \n\
+parallel_job = cPickle.load( open(pdir, 'rb') ) \n\
 core_i = int(sys.argv[1]) \n\
 ncores = int(sys.argv[2]) \n\
 parallel_job.run_core(core_i, ncores) ")
@@ -251,8 +251,8 @@ exit 0" )
         # Compute world coordinates of all in-mask voxels.
         # Return indices as sparse matrix of 0's and 1's
         print("start get coords")
-        world_process_mask = self.data.nifti_masker.fit_transform(self.process_mask)
-        world_brain_mask = self.data.nifti_masker.fit_transform(self.data.mask)
+        world_process_mask = self.data.nifti_masker.transform(self.process_mask)
+        world_brain_mask = self.data.nifti_masker.transform(self.data.mask)
 
         process_mask_1D = world_brain_mask.copy()
         process_mask_1D[:,:] = 0
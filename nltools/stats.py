@@ -1,11 +1,17 @@
 """Various statistical helper functions"""
 
-__all__ = ['pearson', 'zscore', 'fdr']
+__all__ = ['pearson', 'zscore', 'fdr', 'ols_factor', 'ols_fit', 'ols_contrast',
+           'permutation_max_t', 'fwe_p', 'cluster_labels', 'cluster_extent',
+           'tfce', 'permutation_cluster', 'RunningStats']
 
 import numpy as np
 import pandas as pdg
-from scipy.stats import ss
+from scipy.stats import ss, t, f
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from copy import deepcopy
+from sklearn.externals.joblib import Parallel, delayed
+from sklearn.utils import check_random_state
 
 def pearson(x, y):
     """ Correlates row vector x with each row vector in 2D array y. 
@@ -59,4 +65,583 @@ def fdr(p, q=.05):
 
 
 
-    
\ No newline at end of file
+    
+
+def ols_factor(X):
+    """ Factor a design matrix once (QR) so it can be reused for OLS fits of
+    many columns of data.
+
+    Args:
+        X: design matrix (observations x regressors)
+
+    Returns:
+        factor: dictionary {'x','q','r_inv','xtx_inv','se_scale','q_sum','df'}
+
+    """
+
+    X = np.asarray(X, dtype=np.float64)
+    q, r = np.linalg.qr(X)
+    r_inv = np.linalg.inv(r)
+    # diag(inv(X'X)) = diag(inv(R) inv(R)') is the row sum of squares of inv(R)
+    se_scale = np.sqrt(np.sum(r_inv**2, axis=1))
+    return {'x':X, 'q':q, 'r_inv':r_inv, 'xtx_inv':np.dot(r_inv, r_inv.T),
+            'se_scale':se_scale, 'q_sum':q.sum(axis=0),
+            'df':X.shape[0]-X.shape[1]}
+
+def ols_fit(factor, Y, residual=False):
+    """ Vectorized OLS fit of every column of Y.
+
+    The residual sum of squares is computed in closed form from Q'Y, so the
+    residual matrix is only formed when requested. t statistics use the
+    unbiased residual variance SSE/df; sigma is the standard deviation of
+    the residuals.
+
+    Args:
+        factor: output of ols_factor
+        Y: data (observations x columns)
+        residual: also return the residual matrix
+
+    Returns:
+        out: dictionary {'beta','t','p','sigma','ss_res'[,'residual']}
+
+    """
+
+    Y = np.asarray(Y, dtype=np.float64)
+    n = Y.shape[0]
+    qty = np.dot(factor['q'].T, Y)
+    b = np.dot(factor['r_inv'], qty)
+    out = {'beta':b}
+    if residual:
+        out['residual'] = Y - np.dot(factor['q'], qty)
+        ss_res = np.einsum('ij,ij->j', out['residual'], out['residual'])
+        sigma = np.std(out['residual'], axis=0)
+    else:
+        ss_res = np.maximum(np.einsum('ij,ij->j', Y, Y) - np.einsum('ij,ij->j', qty, qty), 0)
+        res_mean = (Y.sum(axis=0) - np.dot(factor['q_sum'], qty))/n
+        sigma = np.sqrt(np.maximum(ss_res/n - res_mean**2, 0))
+    out['sigma'] = sigma
+    out['ss_res'] = ss_res
+    out['t'] = b/np.outer(factor['se_scale'], np.sqrt(ss_res/factor['df']))
+    out['p'] = 2*(1-t.cdf(np.abs(out['t']), factor['df']))
+    return out
+
+def ols_contrast(factor, fit, contrast):
+    """ Evaluate a t (vector) or F (matrix) contrast of an OLS fit.
+
+    Standard errors use the unbiased residual variance SSE/df, which matches
+    the degrees of freedom of the t and F distributions of the p-values.
+
+    Args:
+        factor: output of ols_factor
+        fit: output of ols_fit
+        contrast: contrast vector (regressors) or matrix (contrasts x regressors)
+
+    Returns:
+        out: dictionary {'estimate','se','t','p'} for a vector or
+             {'estimate','F','p'} for a matrix
+
+    """
+
+    contrast = np.asarray(contrast, dtype=np.float64)
+    if contrast.ndim not in [1, 2] or contrast.shape[-1] != factor['xtx_inv'].shape[0]:
+        raise ValueError('Contrast does not match the number of regressors.')
+    estimate = np.dot(contrast, fit['beta'])
+    s2 = fit['ss_res']/factor['df']
+    if contrast.ndim == 1:
+        se = np.sqrt(np.dot(np.dot(contrast, factor['xtx_inv']), contrast)*s2)
+        t_stat = estimate/se
+        return {'estimate':estimate, 'se':se, 't':t_stat,
+                'p':2*(1-t.cdf(np.abs(t_stat), factor['df']))}
+    M_inv = np.linalg.inv(np.dot(np.dot(contrast, factor['xtx_inv']), contrast.T))
+    F = np.einsum('ij,ij->j', estimate, np.dot(M_inv, estimate))/(len(contrast)*s2)
+    return {'estimate':estimate, 'F':F, 'p':f.sf(F, len(contrast), factor['df'])}
+
+def permutation_max_t(data, factor=None, n_permute=5000, random_state=None, n_jobs=1, chunk_size=2**24):
+    """ Null distribution of the maximum absolute t statistic across voxels.
+
+    Without a factor, one sample t-tests against 0 are recomputed for random
+    sign flips of the rows of data.  With the factor of a design matrix (see
+    ols_factor), each regressor is tested by permuting the residuals of the
+    design without that regressor (Freedman & Lane, 1983).  Permutation
+    leaves the mean of the data unchanged, so constant regressors (the
+    intercept) are tested with sign flips of the residuals instead, which
+    assumes symmetric errors.  Each batch of permutations is a single matrix product with a block of
+    voxels, so memory is bounded by chunk_size elements per batch.
+
+    Args:
+        data: data (observations x voxels), can be a np.memmap
+        factor: output of ols_factor or None for a one sample t-test
+        n_permute: number of permutations
+        random_state: seed or np.random.RandomState
+        n_jobs: number of threads
+        chunk_size: approximate number of elements processed per batch
+
+    Returns:
+        max_t: maximum |t| per permutation (n_permute,) or
+               (n_permute x regressors) with a factor
+
+    """
+
+    n, n_voxels = data.shape
+    perms = _draw_permutations(n, factor, n_permute, random_state)
+    if factor is None:
+        max_t = np.zeros(n_permute)
+    else:
+        perms, signs = perms
+        nuisance = _nuisance(factor)
+        max_t = np.zeros((n_permute, factor['q'].shape[1]))
+
+    block = min(n_voxels, 2**16)
+    batch = max(1, chunk_size//(4*block))
+    with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+        for start in range(0, n_voxels, block):
+            Y = np.asarray(data[:, start:start+block], dtype=np.float64)
+            if factor is None:
+                ss = np.einsum('ij,ij->j', Y, Y)
+                out = parallel(delayed(_sign_flip_max_t)(Y, ss, perms[i:i+batch])
+                               for i in range(0, n_permute, batch))
+            else:
+                out = parallel(delayed(_freedman_lane_max_t)(Y, factor, nuisance, perms[i:i+batch],
+                                                             signs[i:i+batch])
+                               for i in range(0, n_permute, batch))
+            max_t = np.maximum(max_t, np.concatenate(out))
+    return max_t
+
+def fwe_p(stat, max_t):
+    """ Family-wise error corrected p-values from a max statistic null distribution.
+
+    Args:
+        stat: observed statistics (voxels,) or (regressors x voxels)
+        max_t: output of permutation_max_t
+
+    Returns:
+        p: corrected two-sided p-values, same shape as stat
+
+    """
+
+    stat = np.abs(np.asarray(stat, dtype=np.float64))
+    max_t = np.sort(np.asarray(max_t, dtype=np.float64).reshape(len(max_t), -1), axis=0)
+    flat = stat.reshape(max_t.shape[1], -1)
+    p = np.empty(flat.shape)
+    for i in range(flat.shape[0]):
+        count = max_t.shape[0] - np.searchsorted(max_t[:, i], flat[i], side='left')
+        p[i] = (1. + count)/(max_t.shape[0] + 1)
+    p = p.reshape(stat.shape)
+    p[np.isnan(stat)] = np.nan
+    return p
+
+class RunningStats(object):
+    """ Streaming mean, variance, t, min, max and count of each column.
+
+    Batches of observations are merged into running moments with the
+    parallel update of Chan et al. (1979), so data can be consumed one block
+    at a time in a single pass.  Accumulators of disjoint parts of the data
+    (e.g. from different processes) merge into exactly the moments of the
+    whole.  Non-finite values are treated as missing, so counts may differ
+    between columns.
+
+    """
+
+    def __init__(self):
+        self._count = np.zeros(0, dtype=np.int64)
+        self._mean = np.zeros(0)
+        self._m2 = np.zeros(0)
+        self._min = np.zeros(0)
+        self._max = np.zeros(0)
+
+    def __len__(self):
+        return len(self._count)
+
+    def update(self, data):
+        """ Add a batch of observations.
+
+        Args:
+            data: (observations x columns) array or a single observation
+
+        Returns:
+            self
+
+        """
+
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim == 1:
+            data = data[np.newaxis]
+        if data.ndim != 2:
+            raise ValueError('Data must be a vector or a 2D array.')
+        if not len(data):
+            return self
+        finite = np.isfinite(data)
+        if finite.all():
+            n = np.repeat(data.shape[0], data.shape[1])
+            mean = data.mean(axis=0)
+            m2 = ((data - mean)**2).sum(axis=0)
+            low = data.min(axis=0)
+            high = data.max(axis=0)
+        else:
+            n = finite.sum(axis=0)
+            mean = np.where(finite, data, 0).sum(axis=0)/np.maximum(n, 1)
+            m2 = (np.where(finite, data - mean, 0)**2).sum(axis=0)
+            low = np.where(finite, data, np.inf).min(axis=0)
+            high = np.where(finite, data, -np.inf).max(axis=0)
+        self._merge(n, mean, m2, low, high)
+        return self
+
+    def merge(self, other):
+        """ Add the observations summarized by another RunningStats.
+
+        Args:
+            other: RunningStats instance
+
+        Returns:
+            self
+
+        """
+
+        if not isinstance(other, RunningStats):
+            raise ValueError('Can only merge RunningStats instances.')
+        if len(other):
+            self._merge(other._count, other._mean, other._m2, other._min, other._max)
+        return self
+
+    def _merge(self, n, mean, m2, low, high):
+        """ Chan et al. update of the running moments with a summarized batch. """
+
+        if not len(self):
+            self._count = np.zeros(len(n), dtype=np.int64)
+            self._mean = np.zeros(len(n))
+            self._m2 = np.zeros(len(n))
+            self._min = np.repeat(np.inf, len(n))
+            self._max = np.repeat(-np.inf, len(n))
+        elif len(n) != len(self._count):
+            raise ValueError('Data does not have the same number of columns as previous data.')
+        total = self._count + n
+        weight = n/np.maximum(total, 1).astype(np.float64)
+        delta = mean - self._mean
+        self._mean = self._mean + delta*weight
+        self._m2 = self._m2 + m2 + delta**2*self._count*weight
+        self._count = total
+        self._min = np.minimum(self._min, low)
+        self._max = np.maximum(self._max, high)
+
+    def count(self):
+        """ Number of (finite) observations of each column. """
+
+        return self._count.copy()
+
+    def mean(self):
+        """ Mean of each column (nan without observations). """
+
+        return self._where(self._count > 0, self._mean)
+
+    def var(self, ddof=1):
+        """ Variance of each column with ddof delta degrees of freedom. """
+
+        return self._where(self._count > ddof, self._m2/np.maximum(self._count - ddof, 1))
+
+    def std(self, ddof=1):
+        """ Standard deviation of each column with ddof delta degrees of freedom. """
+
+        return np.sqrt(self.var(ddof=ddof))
+
+    def min(self):
+        """ Minimum of each column (nan without observations). """
+
+        return self._where(self._count > 0, self._min)
+
+    def max(self):
+        """ Maximum of each column (nan without observations). """
+
+        return self._where(self._count > 0, self._max)
+
+    def ttest(self):
+        """ One sample t-test of each column against zero.
+
+        Returns:
+            out: dictionary {'t','p'}
+
+        """
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_stat = self.mean()/(self.std()/np.sqrt(self._count))
+        df = np.maximum(self._count - 1, 1)
+        return {'t':t_stat, 'p':2*t.sf(np.abs(t_stat), df)}
+
+    def summary(self):
+        """ All statistics of each column.
+
+        Returns:
+            out: dictionary {'mean','var','std','t','p','min','max','count'}
+
+        """
+
+        out = self.ttest()
+        out.update({'mean':self.mean(), 'var':self.var(), 'std':self.std(),
+                    'min':self.min(), 'max':self.max(), 'count':self.count()})
+        return out
+
+    def _where(self, valid, value):
+        return np.where(valid, value, np.nan)
+
+def _sign_flip_max_t(Y, ss, signs):
+    """ Maximum |t| across voxels for each row of a sign flip matrix. """
+
+    return np.abs(_sign_flip_t(Y, ss, signs)).max(axis=1)
+
+def _sign_flip_t(Y, ss, signs):
+    """ One sample t statistics for each row of a sign flip matrix. """
+
+    n = Y.shape[0]
+    m = np.dot(signs, Y)/n
+    sd = np.sqrt(np.maximum(ss - n*m**2, 0)/(n - 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = m/(sd/np.sqrt(n))
+    t_stat[~np.isfinite(t_stat)] = 0
+    return t_stat
+
+def _nuisance(factor):
+    """ Orthonormal basis of the design without each regressor (None if
+    empty) and whether the regressor is constant. """
+
+    x = factor['x']
+    out = []
+    for j in range(x.shape[1]):
+        z = np.delete(x, j, axis=1)
+        out.append((np.linalg.qr(z)[0] if z.shape[1] else None, np.ptp(x[:, j]) == 0))
+    return out
+
+def _freedman_lane_max_t(Y, factor, nuisance, perms, signs):
+    """ Maximum |t| across voxels per regressor for each permutation. """
+
+    return np.abs(_freedman_lane_t(Y, factor, nuisance, perms, signs)).max(axis=2)
+
+def _freedman_lane_t(Y, factor, nuisance, perms, signs):
+    """ t statistics (permutations x regressors x voxels) of each regressor
+    for row permutations (sign flips for constant regressors) of the
+    residuals of the design without that regressor.
+
+    The nuisance part of the data does not change the t statistic of the
+    tested regressor, so only the permuted residuals are fitted.
+
+    """
+
+    t_stat = np.empty((len(perms), len(nuisance), Y.shape[1]))
+    for j, (q_z, constant) in enumerate(nuisance):
+        res = Y if q_z is None else Y - np.dot(q_z, np.dot(q_z.T, Y))
+        t_stat[:, j] = _permuted_ols_t(res, factor, j, signs if constant else perms, flip=constant)
+    return t_stat
+
+def _permuted_ols_t(Y, factor, j, perms, flip=False):
+    """ t statistics (permutations x voxels) of regressor j for row
+    permutations (or sign flips) of Y.
+
+    Permuting (or flipping the signs of) the rows of Y is the same as
+    permuting (flipping) the rows of Q, so Q'Y for all permutations in the
+    batch is a single matrix product.  Only the coefficient of regressor j,
+    row j of inv(R) times Q'Y, is computed.
+
+    """
+
+    n, k = factor['q'].shape
+    if flip:
+        q = factor['q'][None]*perms[:, :, None]
+    else:
+        q = factor['q'][np.argsort(perms, axis=1)]
+    ss = np.einsum('ij,ij->j', Y, Y)
+    qty = np.dot(q.transpose(0, 2, 1).reshape(-1, n), Y).reshape(len(perms), k, -1)
+    b = np.einsum('k,pkv->pv', factor['r_inv'][j], qty)
+    s = np.sqrt(np.maximum(ss - np.sum(qty**2, axis=1), 0)/factor['df'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = b/(factor['se_scale'][j]*s)
+    t_stat[~np.isfinite(t_stat)] = 0
+    return t_stat
+
+def cluster_labels(stat, adjacency, threshold=0):
+    """ Label clusters of connected voxels with |stat| > threshold.  Positive
+    and negative voxels form separate clusters.
+
+    Args:
+        stat: statistic map (voxels,) in masked space
+        adjacency: voxel adjacency graph (see nltools.mask.get_adjacency)
+        threshold: cluster forming threshold
+
+    Returns:
+        labels: cluster labels (voxels,); 0 for voxels outside clusters
+
+    """
+
+    edges = _edges(adjacency)
+    stat = np.asarray(stat)
+    labels = _label(stat > threshold, edges)
+    negative = _label(-stat > threshold, edges)
+    labels[negative > 0] = negative[negative > 0] + labels.max()
+    return labels
+
+def cluster_extent(stat, adjacency, threshold):
+    """ Size of the cluster (see cluster_labels) each voxel belongs to.
+
+    Args:
+        stat: statistic map (voxels,) in masked space
+        adjacency: voxel adjacency graph (see nltools.mask.get_adjacency)
+        threshold: cluster forming threshold
+
+    Returns:
+        extent: number of voxels in each voxel's cluster; 0 outside clusters
+
+    """
+
+    return _extent(np.asarray(stat), _edges(adjacency), threshold)
+
+def tfce(stat, adjacency, E=.5, H=2, dh=.1):
+    """ Threshold-free cluster enhancement (Smith & Nichols, 2009) of a
+    statistic map.  Positive and negative values are enhanced separately.
+
+    Args:
+        stat: statistic map (voxels,) in masked space
+        adjacency: voxel adjacency graph (see nltools.mask.get_adjacency)
+        E: cluster extent exponent
+        H: cluster height exponent
+        dh: step between cluster forming thresholds
+
+    Returns:
+        tfce: enhanced map (voxels,) with the sign of stat
+
+    """
+
+    return _tfce(np.asarray(stat), _edges(adjacency), E=E, H=H, dh=dh)
+
+def permutation_cluster(data, adjacency, factor=None, threshold=None, tfce=None, n_permute=1000,
+                        random_state=None, n_jobs=1, chunk_size=2**24):
+    """ Null distribution of the maximum cluster statistic across voxels.
+
+    Permutations are drawn as in permutation_max_t.  Batches of t maps are
+    computed with matrix products and every map is clustered in masked space
+    with the voxel adjacency graph, without building 3D images.
+
+    Args:
+        data: data (observations x voxels), can be a np.memmap
+        adjacency: voxel adjacency graph (see nltools.mask.get_adjacency)
+        factor: output of ols_factor or None for a one sample t-test
+        threshold: cluster forming threshold for cluster extent inference
+        tfce: True or dictionary of tfce parameters {'E','H','dh'} for TFCE inference
+        n_permute: number of permutations
+        random_state: seed or np.random.RandomState
+        n_jobs: number of threads
+        chunk_size: approximate number of elements processed per batch
+
+    Returns:
+        max_stat: maximum cluster extent or |tfce| per permutation (n_permute,)
+                  or (n_permute x regressors) with a factor
+
+    """
+
+    if (threshold is None) == (tfce is None or tfce is False):
+        raise ValueError('Set either threshold or tfce.')
+    if tfce is True:
+        tfce = {}
+    n, n_voxels = data.shape
+    perms = _draw_permutations(n, factor, n_permute, random_state)
+    if factor is not None:
+        perms, signs = perms
+        nuisance = _nuisance(factor)
+    edges = _edges(adjacency)
+    block = min(n_voxels, 2**16)
+    n_regressors = 1 if factor is None else factor['q'].shape[1]
+    batch = max(1, chunk_size//(n_voxels*n_regressors))
+    max_stat = []
+    with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+        for i in range(0, n_permute, batch):
+            t_maps = np.empty((len(perms[i:i+batch]), n_regressors, n_voxels))
+            for start in range(0, n_voxels, block):
+                Y = np.asarray(data[:, start:start+block], dtype=np.float64)
+                if factor is None:
+                    ss = np.einsum('ij,ij->j', Y, Y)
+                    t_maps[:, 0, start:start+block] = _sign_flip_t(Y, ss, perms[i:i+batch])
+                else:
+                    t_maps[:, :, start:start+block] = _freedman_lane_t(Y, factor, nuisance, perms[i:i+batch],
+                                                                       signs[i:i+batch])
+            max_stat.extend(parallel(delayed(_max_cluster_stat)(t_map, edges, threshold, tfce)
+                                     for t_map in t_maps))
+    max_stat = np.array(max_stat)
+    return max_stat[:, 0] if factor is None else max_stat
+
+def _draw_permutations(n, factor, n_permute, random_state):
+    """ Sign flips (no factor) or row permutations and sign flips (factor)
+    of n observations. """
+
+    random_state = check_random_state(random_state)
+    if factor is None:
+        return random_state.choice([-1., 1.], size=(n_permute, n))
+    perms = np.array([random_state.permutation(n) for i in range(n_permute)])
+    return perms, random_state.choice([-1., 1.], size=(n_permute, n))
+
+def _edges(adjacency):
+    """ Rows and columns of the upper triangle of an adjacency graph. """
+
+    upper = sparse.triu(adjacency, k=1).tocoo()
+    return upper.row, upper.col
+
+def _label(supra, edges):
+    """ Label connected components of supra threshold voxels (1..n, 0 elsewhere). """
+
+    labels = np.zeros(len(supra), dtype=np.int64)
+    nodes = np.flatnonzero(supra)
+    if len(nodes):
+        components = _components(len(nodes), *_subgraph(supra, nodes, edges))
+        labels[nodes] = components + 1
+    return labels
+
+def _subgraph(supra, nodes, edges):
+    """ Edges between supra threshold voxels, indexed by position in nodes. """
+
+    keep = supra[edges[0]] & supra[edges[1]]
+    position = np.empty(len(supra), dtype=np.int64)
+    position[nodes] = np.arange(len(nodes))
+    return position[edges[0][keep]], position[edges[1][keep]]
+
+def _components(n, rows, cols):
+    """ Connected components (0..k-1) of a graph of n nodes. """
+
+    graph = sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+def _extent(stat, edges, threshold):
+    """ Size of the cluster each voxel belongs to (see cluster_extent). """
+
+    extent = np.zeros(len(stat))
+    for sign in [1, -1]:
+        supra = sign*stat > threshold
+        labels = _label(supra, edges)
+        extent[supra] = np.bincount(labels)[labels[supra]]
+    return extent
+
+def _tfce(stat, edges, E=.5, H=2, dh=.1):
+    """ Threshold-free cluster enhancement of a map (see tfce).
+
+    Voxels and edges below each height are dropped as the height increases,
+    so higher levels only label the shrinking supra threshold graph.
+
+    """
+
+    out = np.zeros(len(stat))
+    for sign in [1, -1]:
+        signed = sign*np.nan_to_num(stat)
+        nodes = np.flatnonzero(signed >= dh)
+        values = signed[nodes]
+        rows, cols = _subgraph(signed >= dh, nodes, edges)
+        for h in dh*np.arange(1, int(signed.max()/dh) + 1):
+            supra = values >= h
+            if not np.all(supra):
+                nodes, values = nodes[supra], values[supra]
+                rows, cols = _subgraph(supra, np.flatnonzero(supra), (rows, cols))
+            if not len(nodes):
+                break
+            components = _components(len(nodes), rows, cols)
+            out[nodes] += sign*np.bincount(components)[components]**E * h**H * dh
+    return out
+
+def _max_cluster_stat(t_map, edges, threshold, tfce):
+    """ Maximum cluster extent or |tfce| of each row of t_map. """
+
+    if tfce is None:
+        return np.array([_extent(row, edges, threshold).max() for row in t_map])
+    return np.array([np.abs(_tfce(row, edges, **tfce)).max() for row in t_map])
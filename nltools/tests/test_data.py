@@ -3,9 +3,21 @@ import numpy as np
 import nibabel as nb
 import pandas as pd
 import glob
+from scipy.stats import t as t_dist
+from copy import deepcopy
 from nltools.simulator import Simulator
-from nltools.data import Brain_Data
+from nltools.data import Brain_Data, _shared_files
 from nltools.data import threshold
+from nltools.mask import create_sphere, get_masker
+from nilearn.input_data import NiftiMasker
+
+def _random_data(n_images, dtype=None):
+    """ Brain_Data of n_images random images in the default mask. """
+
+    dat = Brain_Data(dtype=dtype)
+    n_voxels = int(np.sum(dat.mask.get_data() != 0))
+    dat.data = np.random.randn(n_images, n_voxels).astype(dat.dtype)
+    return dat, n_voxels
 
 def test_data(tmpdir):
     sim = Simulator()
@@ -51,3 +63,559 @@ def test_data(tmpdir):
     i=1
     tt = threshold(out['t'][i], out['p'][i], threshold_dict={'fdr':.05})
     assert tt.shape()[0] == shape_2d[1]
+
+def test_getitem_view():
+    dat, n_voxels = _random_data(10)
+    dat.Y = pd.DataFrame(np.arange(10))
+
+    # Indexing shares mask and data with parent
+    sub = dat[2]
+    assert sub.shape() == (n_voxels,)
+    assert sub.nifti_masker is dat.nifti_masker
+    assert np.may_share_memory(sub.data, dat.data)
+    assert not sub.data.flags.writeable
+
+    # Data is copied before mutation
+    sub = dat[:4]
+    assert sub.shape() == (4, n_voxels)
+    assert len(sub.Y) == 4
+    sub[0] = dat[5]
+    assert np.all(sub.data[0, :] == dat.data[5, :])
+    assert not np.all(dat.data[0, :] == dat.data[5, :])
+    assert not np.may_share_memory(sub.data, dat.data)
+    assert np.all(dat.Y[0].values == np.arange(10))
+
+    # Views are detached before the parent is mutated
+    sub = dat[1]
+    subsub = dat[:4][1]
+    row = dat.data[1].copy()
+    dat[1] = dat[7]
+    assert np.all(dat.data[1] == dat.data[7])
+    assert np.all(sub.data == row)
+    assert np.all(subsub.data == row)
+    assert np.all(sub.Y.values == 1)
+    assert dat.Y[0][1] == 7
+
+    # Indexing never changes the parent's data; detach() before in place changes
+    arr = dat.data
+    sub = dat[:4]
+    row = dat.data[0].copy()
+    assert arr.flags.writeable
+    dat.detach().data *= 2
+    assert np.all(sub.data[0] == row)
+    assert np.all(dat.data[0] == 2*row)
+    sub = dat[:4]
+    sub.detach().data[sub.data < 0] = 0
+    assert np.all(sub.data >= 0)
+    assert np.all(dat.data[0] == 2*row)
+
+def test_memmap(tmpdir):
+    dat, n_voxels = _random_data(20)
+    dat.X = pd.DataFrame({'Intercept':np.ones(20),'X1':np.random.randn(20)})
+
+    mm = dat.to_memmap(str(tmpdir.join('data.npy')))
+    mm.chunk_size = 20*1000
+    # Views are detached but memory-mapped data is written in place
+    row = mm[0]
+    mm[0] = mm[1]
+    assert isinstance(mm.data, np.memmap)
+    assert np.all(np.load(str(tmpdir.join('data.npy')))[0] == dat.data[1])
+    assert np.all(row.data == dat.data[0])
+    mm[0] = dat[0]
+    assert isinstance(mm.data, np.memmap)
+    assert len(mm._chunks(axis=1)) > 1
+    assert mm[0]._chunks(axis=0) == [slice(0, 1)]
+    assert np.allclose(mm[0].astype('float32').data, dat.data[0])
+    assert np.allclose(np.load(str(tmpdir.join('data.npy'))), dat.data)
+
+    assert np.allclose(mm.mean().data, dat.mean().data)
+    assert np.allclose(mm.std().data, dat.std().data)
+    assert np.allclose(mm.ttest()['t'].data, dat.ttest()['t'].data)
+    out, out_mm = dat.regress(residual=True), mm.regress(residual=True)
+    for k in ['beta', 't', 'p', 'sigma', 'residual']:
+        assert np.allclose(out[k].data, out_mm[k].data)
+    for method in ['correlation', 'dot_product']:
+        assert np.allclose(mm.similarity(dat[0], method=method),
+                           dat.similarity(dat[0], method=method))
+        assert np.allclose(mm.similarity(dat[:3], method=method),
+                           dat.similarity(dat[:3], method=method))
+    roi = create_sphere([45, 55, 40], radius=5)
+    assert np.allclose(mm.extract_roi(roi), dat.extract_roi(roi))
+
+def test_load_parallel(tmpdir):
+    sim = Simulator()
+    sim.create_data([0, 1], 1, reps=2, output_dir=str(tmpdir))
+    flist = sorted(glob.glob(str(tmpdir.join('centered*.nii.gz'))))
+    dat = Brain_Data(flist)
+
+    # Threaded loading gives the same data
+    dat_par = Brain_Data(flist, n_jobs=2)
+    assert np.all(dat_par.data == dat.data)
+
+    # Mixed file names, 3D and 4D nibabel images
+    mixed = [flist[0], nb.load(flist[1]), nb.concat_images(flist[2:])]
+    dat_mixed = Brain_Data(mixed, n_jobs=2)
+    assert dat_mixed.shape() == dat.shape()
+    assert np.all(dat_mixed.data == dat.data)
+
+def test_dtype():
+    dat, n_voxels = _random_data(10, dtype='float32')
+    dat.X = pd.DataFrame({'Intercept':np.ones(10),'X1':np.random.randn(10)})
+    assert Brain_Data().dtype == np.float64
+
+    # Derived images keep the instance dtype
+    assert dat.mean().data.dtype == np.float32
+    assert dat.std().data.dtype == np.float32
+    assert dat.ttest()['t'].data.dtype == np.float32
+    out = dat.regress()
+    assert out['beta'].data.dtype == np.float32
+    assert out['t'].data.dtype == np.float32
+    assert dat.mean().to_nifti().get_data_dtype() == np.float32
+
+    # But are computed in float64
+    dat64 = dat.astype('float64')
+    assert dat64.data.dtype == np.float64
+    assert np.allclose(dat.mean().data, dat64.mean().data, atol=1e-6)
+    assert np.allclose(dat.regress()['t'].data, dat64.regress()['t'].data, atol=1e-4)
+    assert not np.may_share_memory(dat.astype('float32').data, dat.data)
+
+def test_save_load(tmpdir):
+    dat, n_voxels = _random_data(10, dtype='float32')
+    dat.Y = pd.DataFrame(np.arange(10))
+    dat.X = pd.DataFrame({'Intercept':np.ones(10),'X1':np.random.randn(10)})
+    file_name = str(tmpdir.join('dat'))
+    dat.save(file_name)
+
+    out = Brain_Data.load(file_name)
+    assert np.all(out.data == dat.data)
+    assert out.dtype == np.float32
+    assert np.all(out.Y == dat.Y)
+    assert np.all(out.X == dat.X)
+    assert out.nifti_masker is dat.nifti_masker
+
+    # Memory-mapped and partial reads
+    out = Brain_Data.load(file_name, mmap_mode='r')
+    assert isinstance(out.data, np.memmap)
+    out = Brain_Data.load(file_name, index=[2, 5])
+    assert np.all(out.data == dat.data[[2, 5]])
+    assert len(out.Y) == 2
+
+    # Mask stored by reference
+    dat.save(str(tmpdir.join('dat_ref')), mask_reference=True)
+    assert not os.path.exists(str(tmpdir.join('dat_ref', 'mask.nii.gz')))
+    out = Brain_Data.load(str(tmpdir.join('dat_ref')))
+    assert out.nifti_masker is dat.nifti_masker
+
+def test_regress_engine():
+    dat, n_voxels = _random_data(20)
+    dat.data += 100
+    dat.X = pd.DataFrame({'Intercept':np.ones(20),'X1':np.random.randn(20)})
+
+    # Compare to the pinv / residual based solution
+    X = np.array(dat.X)
+    b = np.dot(np.linalg.pinv(X), dat.data)
+    res = dat.data - np.dot(X, b)
+    se = np.outer(np.diagonal(np.linalg.inv(np.dot(X.T, X)))**.5, np.sqrt(np.sum(res**2, axis=0)/18))
+    out = dat.regress()
+    assert 'residual' not in out
+    assert np.allclose(out['beta'].data, b)
+    assert np.allclose(out['sigma'].data, np.std(res, axis=0))
+    assert np.allclose(out['t'].data, b/se)
+    assert np.allclose(out['p'].data, 2*t_dist.sf(np.abs(b/se), 18))
+    assert out['t'].nifti_masker is dat.nifti_masker
+    assert np.allclose(dat.regress(residual=True)['residual'].data, res)
+    assert 'sigma' not in dat.regress(sigma=False)
+
+    # Contrasts and several designs in one pass
+    X2 = dat.X.copy()
+    X2['X2'] = np.random.randn(20)
+    out1, out2 = dat.regress(X=[dat.X, X2], contrasts=[
+        {'slope':[0, 1], 'F':[[1, 0], [0, 1]]},
+        {'diff':{'X1':1, 'X2':-1}, 'slope':np.eye(3)[[1]]}])
+    # Contrast inference uses the unbiased residual variance SSE/df
+    t_slope = b[1]/np.sqrt(np.linalg.inv(np.dot(X.T, X))[1, 1]*np.sum(res**2, axis=0)/18)
+    assert np.allclose(out1['contrasts']['slope']['t'].data, t_slope)
+    assert np.allclose(out1['contrasts']['slope']['p'].data, 2*t_dist.sf(np.abs(t_slope), 18))
+    assert out1['contrasts']['F']['F'].shape() == (n_voxels,)
+    assert np.allclose(out1['contrasts']['slope']['t'].data, out1['t'].data[1])
+    assert np.allclose(out1['contrasts']['slope']['p'].data, out1['p'].data[1])
+    assert np.allclose(out2['contrasts']['slope']['F'].data, out2['t'].data[1]**2)
+    assert np.allclose(out2['contrasts']['diff']['estimate'].data,
+                       out2['beta'].data[1] - out2['beta'].data[2])
+    assert np.allclose(out2['beta'].data, dat.regress(X=X2)['beta'].data)
+
+def test_permutation():
+    dat, n_voxels = _random_data(20)
+    dat.data[:, :100] += 10
+    out = dat.ttest(n_permute=50, random_state=0, threshold_dict={'fwe':.05})
+    assert np.all(out['p_fwe'].data[:100] < .05)
+    assert np.sum(np.isnan(out['t'].data)) >= n_voxels - 1000
+    dat.X = pd.DataFrame({'Intercept':np.ones(20),'X1':np.random.randn(20)})
+    out = dat.regress(n_permute=20, random_state=0)
+    assert out['p_fwe'].shape() == (2, n_voxels)
+    assert np.all(out['p_fwe'].data >= 1./21)
+    assert np.all(out['p_fwe'].data[0, :100] == 1./21)
+
+    # Cluster level inference
+    out = dat.ttest(n_permute=10, random_state=0, cluster_dict={'extent':4})
+    assert np.all(out['p_cluster'].data[:100] <= 1./11 + 1e-6)
+    out = dat.ttest(n_permute=3, random_state=0, cluster_dict={'tfce':{'dh':2}})
+    assert out['tfce'].shape() == (n_voxels,)
+    assert np.all(out['p_tfce'].data[:100] <= .25 + 1e-6)
+    labels = out['t'].clusters(threshold=4)
+    assert labels.data.max() >= 1
+
+def test_similarity():
+    dat, n_voxels = _random_data(5)
+    maps = dat.empty()
+    maps.data = np.random.randn(3, n_voxels)
+    dat.chunk_size = 2*n_voxels
+
+    from scipy.stats import spearmanr
+    expected = {'dot_product':lambda x, y: np.dot(x, y),
+                'correlation':lambda x, y: np.corrcoef(x, y)[0, 1],
+                'cosine':lambda x, y: np.dot(x, y)/np.linalg.norm(x)/np.linalg.norm(y),
+                'spearman':lambda x, y: spearmanr(x, y)[0]}
+    for method in expected:
+        out = dat.similarity(maps, method=method)
+        assert out.shape == (3, 5)
+        assert np.isclose(out[2, 4], expected[method](maps.data[2], dat.data[4]))
+        assert dat.similarity(maps[1], method=method).shape == (5,)
+
+    # Masks on the same grid are aligned without NIfTI round trips
+    sphere = create_sphere([45, 54, 45], radius=15)
+    small, maps_small = dat.apply_mask(sphere), maps.apply_mask(sphere)
+    small.to_nifti = maps.to_nifti = None
+    out = small.similarity(maps, method='correlation')
+    assert out.shape == (3, 5)
+    assert np.allclose(out, small.similarity(maps_small, method='correlation'))
+    assert np.allclose(maps.similarity(small, method='correlation'), out.T)
+    try:
+        dat.similarity(maps, method='kendall')
+        assert False
+    except ValueError:
+        pass
+
+def test_distance(tmpdir):
+    from sklearn.metrics.pairwise import pairwise_distances
+    from scipy.spatial.distance import squareform
+    dat = Brain_Data()
+    dat.data = np.random.randn(7, 50) + 1
+    dat.chunk_size = 20
+    for method in ['euclidean', 'correlation', 'cosine', 'cityblock']:
+        expected = pairwise_distances(dat.data, metric=method)
+        assert np.allclose(dat.distance(method=method), expected)
+        assert np.allclose(dat.distance(method=method, condensed=True, n_jobs=2), squareform(expected, checks=False))
+    out = dat.distance(dtype='float32', memmap=str(tmpdir.join('dist.npy')))
+    assert out.dtype == np.float32
+    assert np.allclose(np.load(str(tmpdir.join('dist.npy'))), pairwise_distances(dat.data), atol=1e-3)
+
+def test_extract_roi():
+    dat, n_voxels = _random_data(4)
+    atlas = dat.nifti_masker.inverse_transform(np.random.randint(0, 4, n_voxels).astype(float))
+    labels = dat.nifti_masker.transform(atlas)[0]
+
+    out = dat.extract_roi(atlas)
+    assert out.shape == (4, 4)
+    for i in range(4):
+        assert np.allclose(out[i], dat.data[:, labels == i].mean(axis=1))
+    assert np.allclose(dat.extract_roi(atlas, method='median')[2], np.median(dat.data[:, labels == 2], axis=1))
+    eig = dat.extract_roi(atlas, method='pca')[3]
+    centered = dat.data[:, labels == 3] - dat.data[:, labels == 3].mean(axis=0)
+    assert np.isclose(np.abs(np.corrcoef(eig, np.linalg.svd(centered, full_matrices=False)[0][:, 0])[0, 1]), 1)
+
+    # Binary masks and Brain_Data masks
+    sphere = create_sphere([45, 54, 45], radius=10)
+    in_sphere = dat.nifti_masker.transform(sphere)[0] != 0
+    assert np.allclose(dat.extract_roi(sphere), dat.data[:, in_sphere].mean(axis=1))
+    assert np.allclose(dat.extract_roi(Brain_Data(atlas)), out)
+    assert np.allclose(dat[1].extract_roi(atlas), out[:, 1])
+
+    # Sparse parcellations
+    from nltools.mask import expand_mask
+    rois = expand_mask(atlas, sparse=True)
+    assert rois.shape() == (3, n_voxels)
+    assert np.all(np.array(rois.Y).flatten() == [1, 2, 3])
+    assert np.allclose(dat.extract_roi(rois), out[1:])
+    assert np.allclose(dat.extract_roi(rois, method='median'), dat.extract_roi(atlas, method='median')[1:])
+    assert np.all(rois.to_nifti().get_data()[..., 1] == (atlas.get_data() == 2))
+    assert rois[1].shape() == (1, n_voxels)
+    masked = dat.apply_mask(rois)
+    assert masked.shape() == (4, np.sum(labels != 0))
+    small = dat.apply_mask(sphere)
+    assert np.allclose(small.extract_roi(rois), [small.data[:, small.nifti_masker.transform(atlas)[0] == i].mean(axis=1) for i in [1, 2, 3]])
+
+    # ROIs outside the mask of the data are an error, not NaN
+    outside = create_sphere([30, 54, 45], radius=3)
+    atlas2 = nb.Nifti1Image(create_sphere([45, 54, 45], radius=3).get_data() + 2*outside.get_data(),
+                            affine=dat.mask.affine)
+    for roi, message in [(outside, 'ROI does not'), (expand_mask(atlas2, sparse=True), 'ROI 2 does not')]:
+        try:
+            small.extract_roi(roi)
+            assert False
+        except ValueError as e:
+            assert message in str(e)
+
+def test_icc():
+    dat = Brain_Data()
+    dat.data = np.random.randn(4, 30) + np.random.randn(30)
+
+    # Compare to the design matrix solution
+    Y = dat.data.T
+    n, k = Y.shape
+    X = np.hstack([np.kron(np.eye(k), np.ones((n, 1))), np.tile(np.eye(n), (k, 1))])
+    res = Y.flatten('F') - np.dot(np.dot(np.dot(X, np.linalg.pinv(np.dot(X.T, X))), X.T), Y.flatten('F'))
+    MSE = (res**2).sum()/((n - 1)*(k - 1))
+    SSC = ((np.mean(Y, 0) - np.mean(Y))**2).sum()*n
+    MSR = (((Y - np.mean(Y))**2).sum() - SSC - (res**2).sum())/(n - 1)
+    assert np.isclose(dat.icc('icc3'), (MSR - MSE)/(MSR + (k - 1)*MSE))
+    assert np.isclose(dat.icc('icc2'), (MSR - MSE)/(MSR + (k - 1)*MSE + k*(SSC/(k - 1)/n - MSE)/n))
+
+    # Voxelwise maps from subject x session images
+    dat, n_voxels = _random_data(12)
+    dat.X = pd.DataFrame({'subject':np.repeat(np.arange(6), 2), 'session':np.tile([1, 2], 6)})
+    out = dat.icc('icc3', subject_id='subject', session_id='session')
+    assert out.shape() == (n_voxels,)
+    voxel = Brain_Data()
+    voxel.data = dat.data[:, 100].reshape(6, 2).T
+    assert np.isclose(out.data[100], voxel.icc('icc3'))
+    try:
+        dat.icc('icc1')
+        assert False
+    except NotImplementedError:
+        pass
+
+def test_apply_mask():
+    dat, n_voxels = _random_data(3)
+    sphere = create_sphere([45, 54, 45], radius=10)
+    box = np.zeros(dat.mask.shape)
+    box[20:60, 20:60, 20:60] = 1
+    box = nb.Nifti1Image(box, affine=dat.mask.affine)
+    for mask in [sphere, box]:
+        expected = get_masker(mask).transform(dat.to_nifti())
+        masked = dat.apply_mask(mask)
+        assert np.allclose(masked.data, expected)
+        assert masked.nifti_masker is get_masker(mask)
+        assert np.allclose(masked.to_nifti().get_data(), get_masker(mask).inverse_transform(expected).get_data())
+    assert np.allclose(dat[0].apply_mask(sphere).data, dat.apply_mask(sphere).data[0])
+
+    # Masks on other grids are resampled
+    shifted = nb.Nifti1Image(box.get_data()[::2, ::2, ::2], affine=np.dot(box.affine, np.diag([2, 2, 2, 1])))
+    assert dat.apply_mask(shifted).shape()[1] > 0
+
+def test_resample():
+    from scipy.ndimage import map_coordinates
+    from nilearn.image import resample_img
+    dat, n_voxels = _random_data(2)
+    dat.Y = pd.DataFrame([1, 2])
+    affine = np.dot(dat.mask.affine, np.diag([1.5, 1.5, 1.5, 1]))
+    affine[:3, 3] += .7
+    target = resample_img(dat.mask, target_affine=affine, target_shape=(61, 73, 61), interpolation='nearest')
+
+    out = dat.resample(target)
+    assert out.nifti_masker is get_masker(target)
+    assert np.all(out.Y == dat.Y)
+    in_target = target.get_data() != 0
+    coords = np.dot(np.dot(np.linalg.inv(dat.mask.affine), affine), np.vstack([np.array(np.nonzero(in_target)), np.ones(np.sum(in_target))]))[:3]
+    for i in range(2):
+        expected = map_coordinates(dat.to_nifti().get_data()[..., i], coords, order=1)
+        assert np.allclose(out.data[i], expected)
+    assert np.allclose(dat[0].resample(target, interpolation='nearest').data,
+                       map_coordinates(dat[0].to_nifti().get_data(), coords, order=0))
+    assert np.allclose(out.resample(dat).shape(), dat.shape())
+    assert np.allclose(dat.resample(dat).data, dat.data)
+
+def test_to_nifti(tmpdir):
+    dat, n_voxels = _random_data(3)
+    expected = dat.nifti_masker.inverse_transform(dat.data).get_data()
+    assert np.allclose(dat.to_nifti().get_data(), expected)
+    assert np.allclose(dat[1].to_nifti().get_data(), expected[..., 1])
+
+    # Written through a memory map
+    img = dat.to_nifti(str(tmpdir.join('dat.nii')))
+    assert np.allclose(img.get_data(), expected)
+    assert np.allclose(img.affine, dat.mask.affine)
+    assert np.allclose(Brain_Data(str(tmpdir.join('dat.nii'))).data, dat.data)
+    for name in ['dat.nii.gz', 'dat.nii.bz2']:
+        dat.write(str(tmpdir.join(name)))
+        assert np.allclose(nb.load(str(tmpdir.join(name))).get_data(), expected)
+
+    try:
+        dat.write()
+        assert False
+    except ValueError:
+        pass
+
+    # One file per image
+    names = [str(tmpdir.join('img%s.nii.gz' % i)) for i in range(3)]
+    dat.write(names, n_jobs=2)
+    for i, name in enumerate(names):
+        assert np.allclose(nb.load(name).get_data(), expected[..., i])
+
+def test_pickle(tmpdir):
+    import cPickle
+    dat, n_voxels = _random_data(3)
+    dat.Y = pd.DataFrame([1, 2, 3])
+    out = cPickle.loads(cPickle.dumps(dat, cPickle.HIGHEST_PROTOCOL))
+    assert np.all(out.data == dat.data)
+    assert np.all(out.Y == dat.Y)
+    assert out.mask is dat.mask
+    assert out.nifti_masker is dat.nifti_masker
+
+    # Masks without a file are stored as packed voxels
+    masked = dat.apply_mask(create_sphere([45, 54, 45], radius=10))
+    out = cPickle.loads(cPickle.dumps(masked, cPickle.HIGHEST_PROTOCOL))
+    assert out.nifti_masker is masked.nifti_masker
+    assert np.all(out.data == masked.data)
+
+    # Memory-mapped data is pickled by reference
+    mm = dat.to_memmap(str(tmpdir.join('data.npy')))
+    pickled = cPickle.dumps(mm, cPickle.HIGHEST_PROTOCOL)
+    assert len(pickled) < 100000
+    out = cPickle.loads(pickled)
+    assert isinstance(out.data, np.memmap)
+    assert np.all(out.data == dat.data)
+
+    # Instances pickled with the mask image and masker themselves still load
+    legacy = Brain_Data.__new__(Brain_Data)
+    legacy.__setstate__(deepcopy(dat.__dict__))
+    assert isinstance(legacy.nifti_masker, NiftiMasker)
+    assert np.all(legacy.mask.get_data() == dat.mask.get_data())
+    assert np.all(legacy.data == dat.data)
+    out = cPickle.loads(cPickle.dumps(legacy, cPickle.HIGHEST_PROTOCOL))
+    assert out.nifti_masker is dat.nifti_masker
+
+def test_pickle_relative_mask(tmpdir):
+    import cPickle
+    sphere = create_sphere([45, 54, 45], radius=10)
+    cwd = os.getcwd()
+    try:
+        os.chdir(str(tmpdir))
+        sphere.to_filename('sphere.nii.gz')
+        masked = Brain_Data(mask='sphere.nii.gz')
+        masked.data = np.random.randn(2, int(np.sum(sphere.get_data() != 0)))
+        pickled = cPickle.dumps(masked, cPickle.HIGHEST_PROTOCOL)
+        os.chdir(cwd)
+        out = cPickle.loads(pickled)
+        assert out.mask.get_filename() == str(tmpdir.join('sphere.nii.gz'))
+        assert np.all(out.data == masked.data)
+
+        # Masks that were moved or changed are rebuilt from the pickle
+        os.remove(str(tmpdir.join('sphere.nii.gz')))
+        out = cPickle.loads(pickled)
+        assert np.all(out.mask.get_data() == (sphere.get_data() != 0))
+        assert np.all(out.data == masked.data)
+        create_sphere([45, 54, 45], radius=5).to_filename(str(tmpdir.join('sphere.nii.gz')))
+        out = cPickle.loads(pickled)
+        assert np.all(out.mask.get_data() == (sphere.get_data() != 0))
+    finally:
+        os.chdir(cwd)
+
+def _shared_sum(dat):
+    return float(dat.data.sum()), dat.data.flags.writeable
+
+def test_shared_memory():
+    import cPickle
+    from sklearn.externals.joblib import Parallel, delayed
+    dat, n_voxels = _random_data(3)
+    with dat.to_shared_memory() as shared:
+        file_name = shared.data.filename
+        assert os.path.exists(file_name)
+        assert np.all(shared.data == dat.data)
+        assert len(cPickle.dumps(shared, cPickle.HIGHEST_PROTOCOL)) < 100000
+        out = Parallel(n_jobs=2)(delayed(_shared_sum)(shared) for i in range(2))
+        assert np.allclose(out[0][0], dat.data.sum())
+        assert not out[0][1]
+        shared[0].close()
+        deepcopy(shared).close()
+        assert os.path.exists(file_name)
+    assert not os.path.exists(file_name)
+    assert np.allclose(shared.mean().data, dat.mean().data)
+
+    # Shared memory is released when its owner is garbage collected
+    import gc
+    owner = dat.to_shared_memory()
+    sub = owner[:2]
+    file_name = owner.data.filename
+    del owner
+    gc.collect()
+    assert not os.path.exists(file_name)
+    assert not _shared_files
+    assert np.all(sub.data == dat.data[:2])
+
+def test_running_stats(tmpdir):
+    dat, n_voxels = _random_data(5)
+    files = [os.path.join(str(tmpdir), 'image%s.nii.gz' % i) for i in range(3)]
+    for i, f in enumerate(files):
+        dat[i].to_nifti().to_filename(f)
+
+    stats = Brain_Data.running_stats(files, batch_size=2)
+    stats = Brain_Data.running_stats(dat[3:].to_memmap(), stats=stats)
+    out = Brain_Data.from_running_stats(stats)
+    assert np.allclose(out['mean'].data, dat.mean().data, atol=1e-6)
+    assert np.allclose(out['std'].data, dat.data.std(axis=0, ddof=1), atol=1e-6)
+    assert np.allclose(out['t'].data, dat.ttest()['t'].data, atol=1e-4)
+    assert np.all(out['count'].data == 5)
+    assert np.allclose(out['max'].data, dat.data.max(axis=0), atol=1e-6)
+
+def test_append_concat():
+    dat, n_voxels = _random_data(3)
+    dat.Y = pd.DataFrame(np.arange(3))
+    imgs = [dat[i] for i in range(3)]
+
+    out = Brain_Data.concat([dat, dat])
+    assert out.shape() == (6, n_voxels)
+    assert np.all(out.data[3:] == dat.data)
+    assert len(out.Y) == 6
+    assert dat.append(dat).shape() == (6, n_voxels)
+
+    # Growing in place reuses the buffer between reallocations
+    grow = Brain_Data()
+    for i in range(9):
+        grow.append(imgs[i % 3], inplace=True)
+    assert grow.shape() == (9, n_voxels)
+    assert np.all(grow.data[3:6] == dat.data)
+    assert np.all(np.array(grow.Y).flatten() == np.tile(np.arange(3), 3))
+    assert grow._append_buffers['data'].shape[0] == 16
+    copied = deepcopy(grow)
+    assert not hasattr(copied, '_append_buffers')
+    assert np.all(copied.data == grow.data)
+
+def test_bootstrap_moments():
+    dat, n_voxels = _random_data(8)
+    dat.chunk_size = 3*n_voxels
+
+    weights = np.random.RandomState(0).multinomial(8, [1/8.]*8, size=10)/8.
+    for analysis_type in ['mean', 'std']:
+        out = dat.bootstrap(analysis_type, n_samples=10, save_weights=True, random_state=0)
+        if analysis_type == 'mean':
+            samples = np.dot(weights, dat.data)
+        else:
+            samples = np.array([np.sqrt(np.average((dat.data - np.dot(w, dat.data))**2, axis=0, weights=w))
+                                for w in weights])
+        assert np.allclose(out['samples'].data, samples)
+        assert np.allclose(out['mean'].data, samples.mean(axis=0))
+        assert np.allclose(out['Z'].data, samples.mean(axis=0)/samples.std(axis=0))
+        assert 'samples' not in dat.bootstrap(analysis_type, n_samples=10, random_state=0)
+
+def test_bootstrap_parallel():
+    dat, n_voxels = _random_data(12)
+    dat.X = pd.DataFrame({'Intercept':np.ones(12),'X1':np.random.randn(12)})
+    dat.Y = pd.DataFrame(np.random.randn(12))
+    dat.chunk_size = 2*2*n_voxels
+
+    # Results do not depend on the number of workers
+    out = dat.bootstrap('regress', n_samples=6, save_weights=True, random_state=1)
+    out_par = dat.bootstrap('regress', n_samples=6, save_weights=True, random_state=1, n_jobs=2)
+    assert not _shared_files
+    assert out['Z'].shape() == (2, n_voxels)
+    assert out['samples'].shape() == (12, n_voxels)
+    for k in ['Z', 'p', 'mean', 'samples']:
+        assert np.allclose(out[k].data, out_par[k].data)
+    assert np.allclose(out['mean'].data[0], out['samples'].data[:6].mean(axis=0))
+    assert np.allclose(out['Z'].data[1], out['samples'].data[6:].mean(axis=0)/out['samples'].data[6:].std(axis=0))
+
+    out = dat.bootstrap('predict', n_samples=3, random_state=1, algorithm='ridge')
+    out_par = dat.bootstrap('predict', n_samples=3, random_state=1, n_jobs=2, algorithm='ridge')
+    assert out['Z'].shape() == (n_voxels,)
+    assert np.allclose(out['mean'].data, out_par['mean'].data)
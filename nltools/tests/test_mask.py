@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import nibabel as nb
+from copy import deepcopy
+from nltools.data import Brain_Data
+from nltools.mask import load_mask, get_masker, get_mask_hash, get_mask_alignment
+from nltools.utils import get_resource_path, LRUCache
+
+def test_mask_cache(tmpdir):
+    mask_file = os.path.join(get_resource_path(), 'MNI152_T1_2mm_brain_mask.nii.gz')
+
+    # Loaded masks and fitted maskers are reused
+    assert load_mask() is load_mask(mask_file)
+    assert get_masker() is get_masker(mask_file)
+
+    # Maskers are keyed by mask content
+    mask = load_mask()
+    mask_copy = nb.Nifti1Image(mask.get_data().copy(), affine=mask.affine)
+    assert get_mask_hash(mask_copy) == get_mask_hash(mask)
+    assert get_masker(mask_copy) is get_masker(mask)
+    other = mask.get_data().copy()
+    other[45, 54, 45] = 0
+    other = nb.Nifti1Image(other, affine=mask.affine)
+    assert get_mask_hash(other) != get_mask_hash(mask)
+
+    # Changing the caller's image afterwards does not change the cached masker
+    n_voxels = np.sum(other.get_data() != 0)
+    masker = get_masker(other)
+    assert masker.mask_img is not other
+    other_hash = get_mask_hash(other)
+    other.get_data()[:45] = 0
+    assert np.sum(masker.mask_img.get_data() != 0) == n_voxels
+    assert get_mask_hash(other) != other_hash
+
+    # Cached images are shared, so they cannot be changed in place
+    assert not load_mask().get_data().flags.writeable
+    assert not masker.mask_img.get_data().flags.writeable
+
+    # All Brain_Data instances share one mask and masker
+    dat1, dat2 = Brain_Data(), Brain_Data(mask=mask_file)
+    assert dat1.mask is dat2.mask
+    assert dat1.nifti_masker is dat2.nifti_masker
+    assert deepcopy(dat1).nifti_masker is dat1.nifti_masker
+
+def test_mask_alignment():
+    mask = load_mask()
+    other = mask.get_data().copy()
+    other[:45] = 0
+    other = nb.Nifti1Image(other, affine=mask.affine)
+    index1, index2 = get_mask_alignment(mask, other)
+    assert get_mask_alignment(mask, other)[0] is index1
+    img = nb.Nifti1Image(np.random.randn(*mask.shape), affine=mask.affine)
+    assert len(index2) == np.sum(other.get_data() != 0)
+    assert np.all(get_masker(mask).transform(img)[:, index1] == get_masker(other).transform(img))
+    shifted = nb.Nifti1Image(mask.get_data(), affine=mask.affine + np.eye(4))
+    assert get_mask_alignment(mask, shifted) is None
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.get('b') is None
+    assert len(cache) == 2
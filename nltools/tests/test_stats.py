@@ -0,0 +1,103 @@
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+from scipy.stats import ttest_1samp
+from nltools.mask import get_adjacency
+from nltools.stats import (ols_factor, ols_fit, permutation_max_t, fwe_p, cluster_labels,
+                           cluster_extent, tfce, permutation_cluster, RunningStats)
+
+def test_permutation_max_t():
+    rs = np.random.RandomState(0)
+    data = rs.randn(12, 50)
+    data[:, :5] += 2
+
+    # Sign flips in small batches match a brute force loop
+    max_t = permutation_max_t(data, n_permute=200, random_state=1, n_jobs=2, chunk_size=100)
+    signs = np.random.RandomState(1).choice([-1., 1.], size=(200, 12))
+    expected = [np.abs(ttest_1samp(data*s[:, None], 0)[0]).max() for s in signs]
+    assert np.allclose(max_t, expected)
+    p = fwe_p(ttest_1samp(data, 0)[0], max_t)
+    assert np.all(p[:5] < .05)
+    assert np.all(p >= 1./201)
+
+    # Permutations of residuals of a design, sign flips for the intercept
+    X = np.column_stack([np.ones(12), rs.randn(12)])
+    factor = ols_factor(X)
+    max_t = permutation_max_t(data, factor, n_permute=50, random_state=2, chunk_size=100)
+    draws = np.random.RandomState(2)
+    perms = [draws.permutation(12) for i in range(50)]
+    signs = draws.choice([-1., 1.], size=(50, 12))
+    res = data - np.outer(X[:, 1], np.dot(X[:, 1], data))/np.dot(X[:, 1], X[:, 1])
+    expected = [[np.abs(ols_fit(factor, res*s[:, None])['t'][0]).max(),
+                 np.abs(ols_fit(factor, data[i])['t'][1]).max()] for i, s in zip(perms, signs)]
+    assert np.allclose(max_t, expected)
+    assert fwe_p(ols_fit(factor, data)['t'], max_t).shape == (2, 50)
+
+def test_clusters():
+    rs = np.random.RandomState(0)
+    mask = np.zeros((8, 9, 10))
+    mask[1:7, 1:8, 1:9] = 1
+    mask = nb.Nifti1Image(mask, affine=np.eye(4))
+    in_mask = mask.get_data() != 0
+    adjacency = get_adjacency(mask, connectivity=6)
+    assert adjacency is get_adjacency(mask, connectivity=6)
+    assert adjacency.shape == (in_mask.sum(),)*2
+    assert (adjacency != adjacency.T).nnz == 0
+
+    # Labels match 3D connected component labelling
+    stat = rs.randn(in_mask.sum())
+    vol = np.zeros(in_mask.shape)
+    vol[in_mask] = stat
+    for connectivity, structure in [(6, 1), (26, 3)]:
+        labels = cluster_labels(stat, get_adjacency(mask, connectivity), threshold=1)
+        expected = ndimage.label(vol > 1, ndimage.generate_binary_structure(3, structure))[0][in_mask]
+        assert labels.max() == expected.max() + ndimage.label(vol < -1, ndimage.generate_binary_structure(3, structure))[1]
+        assert np.all((labels[stat > 1] > 0))
+        assert len(set(zip(labels[stat > 1], expected[stat > 1]))) == expected.max()
+    extent = cluster_extent(stat, adjacency, 1)
+    assert np.all(extent[np.abs(stat) <= 1] == 0)
+    assert extent.max() == np.bincount(cluster_labels(stat, adjacency, 1))[1:].max()
+
+    # Single supra threshold voxel: tfce = sum of h**2 * dh
+    stat = np.zeros(in_mask.sum())
+    stat[10] = 1.
+    assert np.isclose(tfce(stat, adjacency, dh=.5)[10], .5**2*.5 + 1*.5)
+
+    # Cluster null distribution
+    data = rs.randn(8, in_mask.sum())
+    null = permutation_cluster(data, adjacency, threshold=2, n_permute=20, random_state=0, chunk_size=1000)
+    signs = np.random.RandomState(0).choice([-1., 1.], size=(20, 8))
+    expected = [cluster_extent(ttest_1samp(data*i[:, None], 0)[0], adjacency, 2).max() for i in signs]
+    assert np.allclose(null, expected)
+    null = permutation_cluster(data, adjacency, factor=ols_factor(np.column_stack([np.ones(8), rs.randn(8)])),
+                               tfce=True, n_permute=5, random_state=0)
+    assert null.shape == (5, 2)
+
+def test_running_stats():
+    rs = np.random.RandomState(0)
+    data = rs.randn(30, 6)*3 + 5
+
+    # Batches and merged partial accumulators match a single pass
+    stats = RunningStats()
+    for i in range(0, 30, 7):
+        stats.update(data[i:i+7])
+    merged = RunningStats().update(data[:10]).merge(RunningStats().update(data[10:]))
+    merged.update(np.zeros((0, 6)))
+    for s in [stats, merged]:
+        assert np.all(s.count() == 30)
+        assert np.allclose(s.mean(), data.mean(axis=0))
+        assert np.allclose(s.var(), data.var(axis=0, ddof=1))
+        assert np.allclose(s.std(ddof=0), data.std(axis=0))
+        assert np.allclose(s.ttest()['t'], ttest_1samp(data, 0)[0])
+        assert np.allclose(s.ttest()['p'], ttest_1samp(data, 0)[1])
+        assert np.all(s.min() == data.min(axis=0))
+        assert np.all(s.max() == data.max(axis=0))
+
+    # Non-finite values are missing observations
+    data[:4, 0] = np.nan
+    data[:, 1] = np.nan
+    stats = RunningStats().update(data[:15]).update(data[15:])
+    assert np.all(stats.count() == [26, 0, 30, 30, 30, 30])
+    assert np.allclose(stats.mean()[0], data[4:, 0].mean())
+    assert np.allclose(stats.var()[0], data[4:, 0].var(ddof=1))
+    assert np.isnan(stats.summary()['max'][1])
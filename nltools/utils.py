@@ -1,6 +1,6 @@
 """Handy utilities"""
 
-__all__ = ['get_resource_path','get_anatomical','set_algorithm','get_n_slices','get_ta','get_slice_order','get_n_volumes','get_vox_dims']
+__all__ = ['get_resource_path','get_anatomical','set_algorithm','get_n_slices','get_ta','get_slice_order','get_n_volumes','get_vox_dims','LRUCache']
 __author__ = ["Luke Chang"]
 __license__ = "MIT"
 
@@ -9,6 +9,8 @@ import pandas as pd
 import nibabel as nib
 import importlib
 import os
+import threading
+from collections import OrderedDict
 
 def get_resource_path():
     """ Get path to nltools resource directory. """
@@ -123,3 +125,45 @@ def get_vox_dims(volume):
     hdr = nii.get_header()
     voxdims = hdr.get_zooms()
     return [float(voxdims[0]), float(voxdims[1]), float(voxdims[2])]
+
+class LRUCache(object):
+    """ Thread-safe dictionary that discards its least recently used items.
+
+    Args:
+        maxsize: maximum number of items to keep
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()